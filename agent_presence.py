@@ -0,0 +1,127 @@
+# agent_presence.py
+import datetime
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import bindparam, select
+
+from models import AGENT_HEARTBEAT_TTL, Agent, db
+
+# Heartbeats not yet written to the database. Only batches the writes:
+# whether an agent is online is always read from the stored heartbeat
+# Structure: {agent_id: (epoch seconds, system_info or None)}
+_pending = {}
+_pending_lock = threading.Lock()
+
+# An agent counts as online for this long after its last heartbeat
+HEARTBEAT_TTL = AGENT_HEARTBEAT_TTL
+
+# How often buffered heartbeats are written to the agents table
+FLUSH_INTERVAL = 5  # seconds
+
+# Extra slack before startup marks agents offline: heartbeats the previous
+# process still had buffered (up to FLUSH_INTERVAL) die with it on a crash,
+# and agents only heartbeat every 30 seconds by default
+STARTUP_GRACE = FLUSH_INTERVAL + 30  # seconds
+
+def mark_offline(agent_id: int) -> None:
+    """Forget an agent's buffered heartbeat, e.g. after it has been deleted"""
+    with _pending_lock:
+        _pending.pop(agent_id, None)
+
+def record_heartbeat(agent_id: int, system_info: Optional[dict] = None) -> None:
+    """Queue an agent's heartbeat for the next flush"""
+    with _pending_lock:
+        _pending[agent_id] = (int(time.time()), system_info)
+
+def has_pending() -> bool:
+    """True if there are heartbeats waiting to be flushed"""
+    return bool(_pending)
+
+def is_online(agent_id: Optional[int]) -> bool:
+    """Check whether an agent's stored heartbeat is within the TTL"""
+    if agent_id is None:
+        return False
+    return db.session.execute(
+        select(Agent.id).where(
+            Agent.id == agent_id,
+            Agent.status == 'online',
+            Agent.last_heartbeat_ts > int(time.time()) - HEARTBEAT_TTL
+        )
+    ).first() is not None
+
+def flush_heartbeats(connection) -> int:
+    """
+    Write buffered heartbeats to the agents table and mark expired agents
+    offline, using at most three UPDATEs. Idle ticks are skipped (see
+    has_pending); readers don't depend on the expiry UPDATE running.
+
+    Expiry goes by the stored last_heartbeat_ts, so agents still marked
+    online from before a restart are caught too once their last heartbeat
+    passes the TTL. Readers don't wait for it: see models.agent_status.
+
+    Args:
+        connection: SQLAlchemy connection inside a transaction
+
+    Returns:
+        Number of agent rows written
+    """
+    with _pending_lock:
+        pending = _pending.copy()
+        _pending.clear()
+
+    agents = Agent.__table__
+    with_info, without_info = [], []
+    for agent_id, (seen_ts, system_info) in pending.items():
+        # The DateTime column is kept for existing readers
+        row = {
+            'agent_id': agent_id,
+            'seen_ts': seen_ts,
+            'seen_at': datetime.datetime.utcfromtimestamp(seen_ts)
+        }
+        if system_info is not None:
+            row['info'] = system_info
+            with_info.append(row)
+        else:
+            without_info.append(row)
+
+    online = agents.update().where(agents.c.id == bindparam('agent_id'))
+    if with_info:
+        connection.execute(
+            online.values(status='online', last_heartbeat=bindparam('seen_at'),
+                          last_heartbeat_ts=bindparam('seen_ts'), system_info=bindparam('info')),
+            with_info
+        )
+    if without_info:
+        connection.execute(
+            online.values(status='online', last_heartbeat=bindparam('seen_at'),
+                          last_heartbeat_ts=bindparam('seen_ts')),
+            without_info
+        )
+    # Runs after the writes above, so every heartbeat this process has seen
+    # is already in last_heartbeat_ts
+    cutoff = int(time.time()) - HEARTBEAT_TTL
+    result = connection.execute(
+        agents.update()
+        .where(agents.c.status == 'online')
+        .where((agents.c.last_heartbeat_ts < cutoff) | agents.c.last_heartbeat_ts.is_(None))
+        .values(status='offline')
+    )
+
+    return len(pending) + result.rowcount
+
+def mark_stale_offline(connection) -> None:
+    """
+    Mark agents offline whose stored heartbeat is older than the TTL plus
+    STARTUP_GRACE. Run once at startup, so the restart gap (and heartbeats
+    lost with the previous process) doesn't knock live agents offline.
+    """
+    agents = Agent.__table__
+    cutoff = int(time.time()) - HEARTBEAT_TTL - STARTUP_GRACE
+    connection.execute(
+        agents.update()
+        .where(agents.c.status != 'offline')
+        .where((agents.c.last_heartbeat_ts < cutoff) | agents.c.last_heartbeat_ts.is_(None))
+        .values(status='offline')
+    )
@@ -16,16 +16,22 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from firewall_api import firewall_bp
 # Import models and auth
-from models import Command, db, User, Agent, Project
+from models import Command, db, User, Agent, Project, upgrade_schema
 from auth import auth_bp
-from projects import projects_bp
+from projects import (
+    projects_bp, cached_agent_ref, forget_agent_api_keys, resolve_agent_api_key,
+    record_agent_heartbeat, INVALID_API_KEY_BODY, SUCCESS_BODY
+)
 from security_middleware import disable_csp  # Import the new middleware
+from json_provider import OrjsonProvider
+import agent_presence
+import log_buffer
 
 # Proxy / tunnel modules
 from aiohttp import web
 import tunnels_with_firewall as tunnelv2  # Use the debug version
 from subdomain_handling import generate_subdomain, extract_subdomain
-from firewall_models import FirewallRule
+from firewall_models import FirewallRule, ensure_firewall_rule_index
 # WSGI adapter for Flask in aiohttp
 from aiohttp_wsgi import WSGIHandler
 
@@ -52,18 +58,24 @@ DATABASE_PATH = os.path.join(INSTANCE_FOLDER, 'app.db')
 DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 tunnelv2.set_request_timeout(REQUEST_TIMEOUT)
 
+# Shared engine options; the statement cache is sized so every distinct
+# query shape the app issues stays compiled
+ENGINE_OPTIONS = {'pool_pre_ping': True, 'query_cache_size': 1200}
+
 # SQLAlchemy session for proxy
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(DATABASE_URL, **ENGINE_OPTIONS)
 SessionLocal = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 
 # =========================
 # Flask app setup
 # =========================
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # orjson-backed jsonify (falls back to stdlib json)
 app.config.update(
     SECRET_KEY=os.environ.get('SECRET_KEY', 'change-this-in-production'),
     SQLALCHEMY_DATABASE_URI=DATABASE_URL,
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    SQLALCHEMY_ENGINE_OPTIONS=ENGINE_OPTIONS,
     GALLERY_MAX_FILE_BYTES=5 * 1024 * 1024,
     GALLERY_MAX_COUNT=300,
     UPLOAD_FOLDER=os.path.join('static', 'uploads'),
@@ -382,6 +394,8 @@ def delete_agent(agent_id):
         
         db.session.delete(agent)
         db.session.commit()
+        agent_presence.mark_offline(agent_id)
+        forget_agent_api_keys(agent_id)
         
         log.info(f"Agent deleted: {agent.name} (ID: {agent_id})")
         
@@ -408,7 +422,7 @@ def start_project(project_id):
         if not project.agent:
             return jsonify({'success': False, 'message': 'No agent assigned'}), 400
         
-        if project.agent.status != 'online':
+        if not agent_presence.is_online(project.agent_id):
             return jsonify({'success': False, 'message': 'Agent is offline'}), 400
         
         # Set pending action for agent to pick up
@@ -530,11 +544,8 @@ def agent_heartbeat():
         return jsonify({'success': False, 'message': 'Invalid API key'}), 401
     
     try:
-        data = request.get_json()
-        agent.status = 'online'
-        agent.last_heartbeat = datetime.datetime.utcnow()
-        agent.system_info = data.get('system_info', {})
-        db.session.commit()
+        data = request.get_json(silent=True)
+        agent_presence.record_heartbeat(agent.id, data.get('system_info') if data else None)
         
         return jsonify({'success': True, 'message': 'Heartbeat received'})
     except Exception as e:
@@ -737,7 +748,7 @@ async def http_handler_wrapper(request: web.Request):
     return await http_handler(
         request=request,
         domain=DOMAIN,
-        db_session=db.session,
+        db_session=SessionLocal,
         project_model=Project,
         status_handler_func=status_handler,
         firewall_rule_model=FirewallRule  # Pass the FirewallRule model to enable firewall checks
@@ -750,6 +761,36 @@ async def http_handler_wrapper(request: web.Request):
 # Create WSGI handler once (reusable)
 flask_wsgi_handler = WSGIHandler(app)
 
+def resolve_agent_in_app_context(api_key):
+    """API key lookup for the native handlers (runs in a worker thread)"""
+    with app.app_context():
+        try:
+            return resolve_agent_api_key(api_key)
+        finally:
+            db.session.remove()
+
+async def agent_heartbeat_handler(request: web.Request):
+    """
+    Agent heartbeat without a WSGI round-trip. A heartbeat only touches the
+    in-memory presence buffer, so unless the API key isn't cached yet it
+    runs entirely on the event loop.
+    """
+    api_key = request.headers.get('X-Agent-API-Key')
+    agent = cached_agent_ref(api_key) if api_key else None
+    if agent is None and api_key:
+        loop = asyncio.get_running_loop()
+        agent = await loop.run_in_executor(None, resolve_agent_in_app_context, api_key)
+    if agent is None:
+        return web.Response(body=INVALID_API_KEY_BODY, status=401, content_type='application/json')
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    # Same helper and body as the blueprint's /api/agent/heartbeat
+    record_agent_heartbeat(agent.id, data)
+    return web.Response(body=SUCCESS_BODY, content_type='application/json')
+
 async def unified_handler(request: web.Request):
     """
     Single handler that routes all requests:
@@ -782,6 +823,10 @@ async def unified_handler(request: web.Request):
         log.debug(f"🌐 Proxying subdomain request: {subdomain}.{DOMAIN}{path}")
         return await http_handler_wrapper(request)
     
+    # Agent heartbeats are handled natively, off the WSGI thread pool
+    if path == '/api/agent/heartbeat' and request.method == 'POST':
+        return await agent_heartbeat_handler(request)
+    
     # Root domain or no subdomain - serve Flask app
     log.debug(f"Serving Flask app for: {host}{path}")
     
@@ -789,12 +834,50 @@ async def unified_handler(request: web.Request):
     request.match_info['path_info'] = request.path
     return await flask_wsgi_handler(request)
 
+def run_flush(flush):
+    """Run a buffer flush in its own transaction (called from a worker thread)"""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            return flush(connection)
+
+def periodic_flush(flush, interval, has_pending=None):
+    """
+    Build an aiohttp cleanup context that calls flush every `interval`
+    seconds in a worker thread, plus once more on shutdown. With
+    has_pending, ticks with nothing buffered skip the thread and connection.
+    """
+    async def flush_context(aio_app):
+        loop = asyncio.get_running_loop()
+
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                if has_pending is not None and not has_pending():
+                    continue
+                try:
+                    await loop.run_in_executor(None, run_flush, flush)
+                except Exception as e:
+                    log.error(f"{flush.__module__} flush failed: {e}")
+
+        task = asyncio.create_task(run())
+        yield
+        task.cancel()
+        # Don't lose whatever was buffered since the last tick
+        await loop.run_in_executor(None, run_flush, flush)
+
+    return flush_context
+
 def create_unified_app():
     """Create unified aiohttp application"""
     aio_app = web.Application(client_max_size=50*1024*1024)
     
     # Single catch-all route that handles everything
     aio_app.router.add_route('*', '/{path_info:.*}', unified_handler)
+    aio_app.cleanup_ctx.append(periodic_flush(agent_presence.flush_heartbeats, agent_presence.FLUSH_INTERVAL,
+                                              agent_presence.has_pending))
+    aio_app.cleanup_ctx.append(periodic_flush(log_buffer.flush, log_buffer.FLUSH_INTERVAL, log_buffer.has_pending))
+    aio_app.cleanup_ctx.append(periodic_flush(tunnelv2.flush_project_status, tunnelv2.STATUS_FLUSH_INTERVAL,
+                                              tunnelv2.has_pending_status))
     
     return aio_app
 
@@ -805,6 +888,10 @@ if __name__ == '__main__':
     # Initialize DB
     with app.app_context():
         db.create_all()
+        with db.engine.begin() as connection:
+            upgrade_schema(connection)
+            ensure_firewall_rule_index(connection)
+            agent_presence.mark_stale_offline(connection)
         log.info("✅ Database initialized")
 
     log.info("=" * 70)
@@ -819,4 +906,11 @@ if __name__ == '__main__':
     
     # Run unified aiohttp server (handles everything)
     unified_app = create_unified_app()
-    web.run_app(unified_app, host='0.0.0.0', port=PORT, access_log=None)
\ No newline at end of file
+    try:
+        import uvloop
+    except ImportError:  # uvloop is optional; the default asyncio loop works too
+        loop = None
+    else:
+        loop = uvloop.new_event_loop()
+        log.info("   Event loop: uvloop")
+    web.run_app(unified_app, host='0.0.0.0', port=PORT, access_log=None, loop=loop)
\ No newline at end of file
@@ -207,28 +207,28 @@ def validate_password(password):
 # Rate Limiting (Simple In-Memory)
 # -------------------------------
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import time
 
-rate_limit_storage = defaultdict(list)
+# Attempt timestamps per identifier, oldest first
+rate_limit_storage = defaultdict(deque)
 
 def is_rate_limited(identifier, max_attempts=5, window_minutes=15):
     """Simple rate limiting"""
-    now = time.time()
-    window_seconds = window_minutes * 60
+    now = time.monotonic()
+    attempts = rate_limit_storage[identifier]
 
-    # Clean old attempts
-    rate_limit_storage[identifier] = [
-        timestamp for timestamp in rate_limit_storage[identifier]
-        if now - timestamp < window_seconds
-    ]
+    # Drop attempts that have left the window (oldest are at the left)
+    cutoff = now - window_minutes * 60
+    while attempts and attempts[0] <= cutoff:
+        attempts.popleft()
 
     # Check if over limit
-    if len(rate_limit_storage[identifier]) >= max_attempts:
+    if len(attempts) >= max_attempts:
         return True
 
     # Add current attempt
-    rate_limit_storage[identifier].append(now)
+    attempts.append(now)
     return False
 
 # -------------------------------
@@ -7,6 +7,7 @@ import platform
 import psutil
 from datetime import datetime
 import signal
+import base64
 import json
 import threading
 import argparse
@@ -15,9 +16,48 @@ import asyncio
 import aiohttp
 from pathlib import Path
 
+try:
+    import msgpack  # optional: compact binary tunnel frames
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson  # optional: faster JSON tunnel frames
+except ImportError:
+    orjson = None
+
+# On msgpack tunnels, response bodies larger than this are streamed to the
+# server in STREAM_CHUNK_SIZE pieces instead of sent as one message
+STREAM_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Longest a streamed response waits for the server to take another chunk
+# before it is given up (the server normally cancels it first)
+STREAM_CREDIT_TIMEOUT = 60
+
+def json_loads(data):
+    """Parse a JSON tunnel frame (text or binary)"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(message)s")
 log = logging.getLogger(__name__)
 
+class StreamCredit:
+    """Chunks of one streamed response the server still has room for"""
+    def __init__(self, window):
+        self.available = window
+        self._granted = asyncio.Event()
+
+    def grant(self):
+        self.available += 1
+        self._granted.set()
+
+    async def take(self):
+        while self.available <= 0:
+            self._granted.clear()
+            await self._granted.wait()
+        self.available -= 1
+
 class WebSocketTunnelThread(threading.Thread):
     """
     Runs the WebSocket tunnel in a background thread with its own asyncio loop.
@@ -30,6 +70,11 @@ class WebSocketTunnelThread(threading.Thread):
         self.local_port = local_port
         self._stop_event = threading.Event()
         self.loop = None
+        self.wire = 'json'  # set from the server's "connected" message
+        self.stream_window = None  # chunks in flight per stream; None = no flow control
+        self._forwards = {}  # request_id -> task forwarding it
+        self._credits = {}  # request_id -> StreamCredit while streaming
+        self._send_lock = None
 
     def run(self):
         self.loop = asyncio.new_event_loop()
@@ -59,21 +104,28 @@ class WebSocketTunnelThread(threading.Thread):
         
         # Add parameters to URL
         ws_url = f"{ws_url}/_tunnel?project_id={self.project_id}&api_key={self.api_key}"
+        if msgpack is not None:
+            ws_url += "&wire=msgpack"
 
         print(f"[Tunnel] Connecting to: {ws_url[:ws_url.index('api_key=')]}api_key=***")
 
-        connector = None
+        ssl_options = {}
         if use_ssl:
             import ssl
             ssl_context = ssl.create_default_context()
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
-            connector = aiohttp.TCPConnector(
-                ssl=ssl_context,
-                limit=100,
-                limit_per_host=30,
-                ttl_dns_cache=300
-            )
+            ssl_options['ssl'] = ssl_context
+        # One connector for the tunnel and every forwarded request. Forwarded
+        # requests all go to the same local host, so the per-host limit is
+        # what caps concurrency; keep-alive reuses the local connections
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=64,
+            keepalive_timeout=30,
+            ttl_dns_cache=300,
+            **ssl_options
+        )
 
         async with aiohttp.ClientSession(
             connector=connector,
@@ -81,26 +133,27 @@ class WebSocketTunnelThread(threading.Thread):
                 'User-Agent': 'ProjectAgent/1.0'
             }
         ) as session:
+            self._send_lock = asyncio.Lock()
             try:
                 ws = await session.ws_connect(
                     ws_url,
                     heartbeat=30,
-                    compress=15,
+                    # MessagePack frames carry raw bodies that rarely deflate
+                    # well; only ask for compression on the JSON wire
+                    compress=0 if msgpack is not None else 15,
                     max_msg_size=10 * 1024 * 1024
                 )
                 print(f"✅ [Tunnel] WebSocket tunnel established for project {self.project_id}")
                 
                 # Wait for connection confirmation
                 async for msg in ws:
-                    if msg.type == aiohttp.WSMsgType.TEXT:
-                        data = json.loads(msg.data)
-                        if data.get('type') == 'connected':
-                            print(f"✅ [Tunnel] Tunnel active: {data.get('url')}")
-                            break
-                    elif msg.type == aiohttp.WSMsgType.BINARY:
-                        data = json.loads(msg.data)
+                    if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        # The confirmation is always JSON
+                        data = json_loads(msg.data)
                         if data.get('type') == 'connected':
-                            print(f"✅ [Tunnel] Tunnel active: {data.get('url')}")
+                            self.wire = data.get('wire', 'json')
+                            self.stream_window = data.get('stream_window')
+                            print(f"✅ [Tunnel] Tunnel active: {data.get('url')} ({self.wire})")
                             break
                     elif msg.type == aiohttp.WSMsgType.ERROR:
                         print(f"❌ [Tunnel] Connection error")
@@ -123,14 +176,26 @@ class WebSocketTunnelThread(threading.Thread):
     async def _handle_requests(self, ws, session):
         while not self._stop_event.is_set():
             msg = await ws.receive()
-            if msg.type == aiohttp.WSMsgType.BINARY:
-                data = json.loads(msg.data)
-                if data.get("type") == "http_request":
-                    await self._forward_request(data, ws, session)
-            elif msg.type == aiohttp.WSMsgType.TEXT:
-                data = json.loads(msg.data)
-                if data.get("type") == "http_request":
-                    await self._forward_request(data, ws, session)
+            if msg.type in (aiohttp.WSMsgType.BINARY, aiohttp.WSMsgType.TEXT):
+                if self.wire == 'msgpack' and msg.type == aiohttp.WSMsgType.BINARY:
+                    data = msgpack.unpackb(msg.data, raw=False)
+                else:
+                    data = json_loads(msg.data)
+                # msgpack tunnels may coalesce several messages into one frame
+                for message in (data if isinstance(data, list) else [data]):
+                    msg_type = message.get("type")
+                    if msg_type == "http_request":
+                        # Forward concurrently so this loop keeps reading
+                        # acks and cancels for responses still streaming
+                        self._start_forward(message, ws, session)
+                    elif msg_type == "http_response_ack":
+                        credit = self._credits.get(message.get("request_id"))
+                        if credit is not None:
+                            credit.grant()
+                    elif msg_type == "http_response_cancel":
+                        task = self._forwards.get(message.get("request_id"))
+                        if task is not None:
+                            task.cancel()
             elif msg.type == aiohttp.WSMsgType.CLOSE:
                 print(f"[Tunnel] WebSocket closed by server")
                 break
@@ -138,6 +203,12 @@ class WebSocketTunnelThread(threading.Thread):
                 print(f"[Tunnel] WebSocket error: {ws.exception()}")
                 break
 
+    def _start_forward(self, request_data, ws, session):
+        request_id = request_data["request_id"]
+        task = asyncio.get_running_loop().create_task(self._forward_request(request_data, ws, session))
+        self._forwards[request_id] = task
+        task.add_done_callback(lambda _: self._forwards.pop(request_id, None))
+
     async def _forward_request(self, request_data, ws, session):
         request_id = request_data["request_id"]
         method = request_data["method"]
@@ -145,6 +216,9 @@ class WebSocketTunnelThread(threading.Thread):
         query_string = request_data.get("query_string", "")
         headers = request_data.get("headers", {})
         body = request_data.get("body", "")
+        if request_data.get("is_binary") and isinstance(body, str):
+            # JSON wire: non-UTF-8 request bodies arrive base64 encoded
+            body = base64.b64decode(body)
         
         url = f"http://localhost:{self.local_port}{path}"
         if query_string:
@@ -152,6 +226,7 @@ class WebSocketTunnelThread(threading.Thread):
         
         print(f"[Tunnel] → {method} {path}")
         
+        streaming = False
         try:
             forward_headers = {}
             skip_headers = {
@@ -166,21 +241,10 @@ class WebSocketTunnelThread(threading.Thread):
                 method=method,
                 url=url,
                 headers=forward_headers,
-                data=body.encode('utf-8') if body else None,
+                data=(body.encode('utf-8') if isinstance(body, str) else body) if body else None,
                 timeout=aiohttp.ClientTimeout(total=30),
                 allow_redirects=False
             ) as resp:
-                response_bytes = await resp.read()
-                
-                try:
-                    response_body = response_bytes.decode('utf-8')
-                    is_binary = False
-                except UnicodeDecodeError:
-                    import base64
-                    response_body = base64.b64encode(response_bytes).decode('ascii')
-                    is_binary = True
-                    print(f"[Tunnel] 📦 Binary response ({len(response_bytes)} bytes)")
-                
                 response_headers = []
                 skip_response_headers = {'transfer-encoding', 'content-encoding'}
                 for key, value in resp.headers.items():
@@ -188,6 +252,34 @@ class WebSocketTunnelThread(threading.Thread):
                     if str_key.lower() not in skip_response_headers:
                         response_headers.append((str_key, str(value)))
                 
+                if self.wire == 'msgpack':
+                    # Small bodies go in one message; larger ones are streamed
+                    # in chunks so neither side holds the whole body
+                    response_bytes = await self._read_up_to(resp, STREAM_THRESHOLD)
+                    if not resp.content.at_eof():
+                        await self._send(ws, {
+                            "type": "http_response_start",
+                            "request_id": request_id,
+                            "status": resp.status,
+                            "headers": response_headers
+                        })
+                        streaming = True
+                        await self._stream_body(ws, request_id, resp, response_bytes)
+                        print(f"[Tunnel] ← {resp.status} {path} (streamed)")
+                        return
+                    # MessagePack carries the bytes as-is, no base64 needed
+                    response_body = response_bytes
+                    is_binary = False
+                else:
+                    response_bytes = await resp.read()
+                    try:
+                        response_body = response_bytes.decode('utf-8')
+                        is_binary = False
+                    except UnicodeDecodeError:
+                        response_body = base64.b64encode(response_bytes).decode('ascii')
+                        is_binary = True
+                        print(f"[Tunnel] 📦 Binary response ({len(response_bytes)} bytes)")
+                
                 response_data = {
                     "type": "http_response",
                     "request_id": request_id,
@@ -197,12 +289,60 @@ class WebSocketTunnelThread(threading.Thread):
                     "is_binary": is_binary
                 }
                 
-                await ws.send_str(json.dumps(response_data))
+                await self._send(ws, response_data)
                 print(f"[Tunnel] ← {resp.status} {path}")
                 
         except Exception as e:
             print(f"[Tunnel] ❌ Error forwarding request: {e}")
-            await self._send_error_response(ws, request_id, 500, str(e))
+            if streaming:
+                # Status and headers are already out; tell the server the
+                # body is incomplete so it fails the response
+                await self._send(ws, {"type": "http_response_end", "request_id": request_id, "error": True})
+            else:
+                await self._send_error_response(ws, request_id, 500, str(e))
+
+    async def _read_up_to(self, resp, limit):
+        """Read the response body until EOF or until limit bytes"""
+        buf = bytearray()
+        while len(buf) < limit:
+            chunk = await resp.content.read(limit - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+        return bytes(buf)
+
+    async def _stream_body(self, ws, request_id, resp, first_chunk):
+        # Servers announcing a stream window ack every chunk their client
+        # takes; never have more than the window unacked
+        credit = StreamCredit(self.stream_window) if self.stream_window else None
+        if credit is not None:
+            self._credits[request_id] = credit
+        try:
+            await self._send_chunk(ws, request_id, first_chunk, credit)
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await self._send_chunk(ws, request_id, chunk, credit)
+        finally:
+            self._credits.pop(request_id, None)
+        await self._send(ws, {"type": "http_response_end", "request_id": request_id})
+
+    async def _send_chunk(self, ws, request_id, chunk, credit):
+        if credit is not None:
+            await asyncio.wait_for(credit.take(), timeout=STREAM_CREDIT_TIMEOUT)
+        await self._send(ws, {"type": "http_response_chunk", "request_id": request_id, "body": chunk})
+
+    async def _send(self, ws, message):
+        # Requests are forwarded concurrently; keep each frame whole
+        async with self._send_lock:
+            await self._send_frame(ws, message)
+
+    async def _send_frame(self, ws, message):
+        if self.wire == 'msgpack':
+            await ws.send_bytes(msgpack.packb(message, use_bin_type=True))
+        elif orjson is not None:
+            # Binary frame straight from orjson's bytes, no str round-trip
+            await ws.send_bytes(orjson.dumps(message))
+        else:
+            await ws.send_str(json.dumps(message))
 
     async def _send_error_response(self, ws, request_id: str, status: int, message: str):
         response_data = {
@@ -214,7 +354,7 @@ class WebSocketTunnelThread(threading.Thread):
             "is_binary": False
         }
         try:
-            await ws.send_str(json.dumps(response_data))
+            await self._send(ws, response_data)
         except Exception:
             pass
 
@@ -164,24 +164,24 @@ def is_ip_temporarily_approved(project_id, ip_address, method, path, db_session=
         if db_session:
             # Use the provided SQLAlchemy session directly
             from firewall_models import FirewallAccessRequest as DirectFirewallAccessRequest
-            request = db_session.query(DirectFirewallAccessRequest).filter_by(
+            query = db_session.query(DirectFirewallAccessRequest).filter_by(
                 project_id=project_id,
                 ip_address=ip_address,
                 method=method,
                 path=path,
                 status="approved"
-            ).filter(DirectFirewallAccessRequest.approved_until > now).first()
+            ).filter(DirectFirewallAccessRequest.approved_until > now)
+            return db_session.query(query.exists()).scalar()
         else:
             # Use Flask-SQLAlchemy when in a Flask context
-            request = FirewallAccessRequest.query.filter_by(
+            query = FirewallAccessRequest.query.filter_by(
                 project_id=project_id,
                 ip_address=ip_address,
                 method=method,
                 path=path,
                 status="approved"
-            ).filter(FirewallAccessRequest.approved_until > now).first()
-        
-        return request is not None
+            ).filter(FirewallAccessRequest.approved_until > now)
+            return db.session.query(query.exists()).scalar()
     except Exception as e:
         # Log the error but don't block the request
         import logging
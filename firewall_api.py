@@ -1,5 +1,5 @@
 import datetime
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, g, jsonify, request, current_app
 from flask_login import login_required, current_user
 from models import db, Project
 from firewall_models import FirewallRule, FirewallAccessRequest
@@ -14,12 +14,21 @@ log = logging.getLogger(__name__)
 # Create blueprint
 firewall_bp = Blueprint('firewall', __name__)
 
+# HTTP methods that can be blocked by a method rule
+VALID_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS')
+_VALID_METHODS = frozenset(VALID_METHODS)
+
+@firewall_bp.before_request
+def stash_current_user_id():
+    """Resolve current_user once per request and keep its id on g"""
+    g.uid = current_user.id if current_user.is_authenticated else None
+
 def check_project_access(project_id):
     """Check if current user has access to the project"""
     project = Project.query.get(project_id)
     if not project:
         return False
-    return project.user_id == current_user.id
+    return project.user_id == g.uid
 
 @firewall_bp.route('/api/projects/<int:project_id>/firewall/rules', methods=['GET'])
 @login_required
@@ -64,10 +73,11 @@ def add_firewall_rule(project_id):
     
     # For method rules, validate HTTP method
     if rule_type == 'method':
-        valid_methods = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
-        if value.upper() not in valid_methods:
-            return jsonify({"error": f"Invalid HTTP method. Must be one of: {', '.join(valid_methods)}"}), 400
-        value = value.upper()
+        # Skip the upper() copy when the client already sent an uppercase method
+        method = value if value in _VALID_METHODS else value.upper()
+        if method not in _VALID_METHODS:
+            return jsonify({"error": f"Invalid HTTP method. Must be one of: {', '.join(VALID_METHODS)}"}), 400
+        value = method
     
     # For pattern rules, validate regex
     if rule_type == 'pattern':
@@ -180,14 +190,14 @@ def import_firewall_rules(project_id):
             created_rules.append(rule)
     
     # Process methods
-    valid_methods = ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
     for method in blocked_methods:
         if not isinstance(method, str):
             continue
             
-        method = method.upper()
-        if method not in valid_methods:
-            continue
+        if method not in _VALID_METHODS:
+            method = method.upper()
+            if method not in _VALID_METHODS:
+                continue
             
         # Check for duplicate
         existing = FirewallRule.query.filter_by(
@@ -234,16 +244,16 @@ def import_firewall_rules(project_id):
             db.session.add(rule)
             created_rules.append(rule)
     
-    # Commit all changes
+    # Flush to assign IDs, then commit all changes
+    db.session.flush()
+    created_ids = [rule.id for rule in created_rules]
     db.session.commit()
     
-    # Get all rules after import
-    all_rules = FirewallRule.query.filter_by(project_id=project_id).all()
-    
     return jsonify({
         "success": True,
-        "message": f"Successfully imported {len(created_rules)} rules",
-        "rules": [rule.to_dict() for rule in all_rules]
+        "message": f"Successfully imported {len(created_ids)} rules",
+        "created_ids": created_ids,
+        "created_count": len(created_ids)
     })
 
 @firewall_bp.route('/api/projects/<int:project_id>/firewall/export', methods=['GET'])
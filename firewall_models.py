@@ -17,6 +17,12 @@ class FirewallRule(db.Model):
     # Relationship with Project
     project = db.relationship('Project', backref=db.backref('firewall_rules', lazy='dynamic', cascade='all, delete-orphan'))
     
+    __table_args__ = (
+        # A named unique index (not a table constraint) so ensure_firewall_rule_index
+        # can add the same thing to tables created before it existed
+        db.Index('uq_firewall_rule', 'project_id', 'rule_type', 'value', unique=True),
+    )
+    
     def to_dict(self):
         """Convert rule to dictionary for JSON serialization"""
         return {
@@ -48,6 +54,10 @@ class FirewallAccessRequest(db.Model):
     project = db.relationship('Project', backref=db.backref('firewall_access_requests', lazy='dynamic', cascade='all, delete-orphan'))
     rule = db.relationship('FirewallRule', backref=db.backref('access_requests', lazy='dynamic'), foreign_keys=[rule_id])
     
+    __table_args__ = (
+        db.Index('ix_firewall_access_approval', 'project_id', 'ip_address', 'status', 'approved_until'),
+    )
+    
     def to_dict(self):
         """Convert access request to dictionary for JSON serialization"""
         return {
@@ -64,6 +74,31 @@ class FirewallAccessRequest(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
+_RULE_KEY = ['project_id', 'rule_type', 'value']
+
+def ensure_firewall_rule_index(connection):
+    """
+    Make sure firewall_rules has its unique (project_id, rule_type, value)
+    index; create_all() never adds one to an existing table, and the
+    ON CONFLICT inserts depend on it. Duplicate rules are removed first,
+    keeping the oldest of each.
+    """
+    for row in connection.exec_driver_sql('PRAGMA index_list(firewall_rules)').fetchall():
+        name, unique = row[1], row[2]
+        if unique:
+            columns = [info[2] for info in connection.exec_driver_sql(f'PRAGMA index_info("{name}")')]
+            if columns == _RULE_KEY:
+                return
+
+    connection.exec_driver_sql(
+        'DELETE FROM firewall_rules WHERE id NOT IN '
+        '(SELECT MIN(id) FROM firewall_rules GROUP BY project_id, rule_type, value)'
+    )
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_firewall_rule '
+        'ON firewall_rules (project_id, rule_type, value)'
+    )
+
 # Helper functions for working with firewall rules
 
 def get_project_firewall_rules(project_id):
@@ -179,12 +214,12 @@ def reject_access_request(request_id):
 def check_access_approval(project_id, ip_address, method, path):
     """Check if there's an approved access request for this request"""
     now = datetime.datetime.utcnow()
-    request = FirewallAccessRequest.query.filter_by(
+    query = FirewallAccessRequest.query.filter_by(
         project_id=project_id,
         ip_address=ip_address,
         method=method,
         path=path,
         status="approved"
-    ).filter(FirewallAccessRequest.approved_until > now).first()
+    ).filter(FirewallAccessRequest.approved_until > now)
     
-    return request is not None
\ No newline at end of file
+    return db.session.query(query.exists()).scalar()
\ No newline at end of file
@@ -1,48 +1,118 @@
 from flask import Blueprint, current_app, jsonify, request, abort
 from flask_login import login_required, current_user
-from models import db, Photo
-from sqlalchemy import func
-from utils_images import save_user_image, delete_user_image
+from models import db, Photo, adjust_photo_counters
+from sqlalchemy import and_, bindparam, or_, select
+from utils_images import save_user_image, delete_user_image, remove_image_files
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import base64
+import binascii
+import datetime
+import operator
 import os
 
 gallery_bp = Blueprint('gallery', __name__, url_prefix='/gallery')
 
+# Columns returned by the photo endpoints, fetched in one call per row
+_PHOTO_COLUMNS = ('id', 'stored_filename', 'created_at', 'file_size', 'width', 'height')
+_photo_fields = operator.attrgetter(*_PHOTO_COLUMNS)
+
+# Built once at import; the compiled form is reused from the statement cache
+_PHOTO_BY_ID = select(Photo).where(
+    Photo.id == bindparam('pid'),
+    Photo.user_id == bindparam('uid')
+)
+
+def _get_owned_photo_or_404(photo_id):
+    """Load one of the current user's photos or abort with 404"""
+    photo = db.session.execute(
+        _PHOTO_BY_ID, {'pid': photo_id, 'uid': current_user.id}
+    ).scalar_one_or_none()
+    if photo is None:
+        abort(404)
+    return photo
+
+@lru_cache(maxsize=1024)
+def _photo_url_prefixes(user_id):
+    """Return the (url, thumbnail) prefixes for a user's photos, built once per user"""
+    url_prefix = '/uploads/users/' + str(user_id) + '/'
+    return url_prefix, url_prefix + 'thumbs/'
+
+def _serialize_photo(photo, url_prefix, thumb_prefix):
+    """Serialize a Photo (or a projected row with the same columns) for the API"""
+    photo_id, filename, created_at, file_size, width, height = _photo_fields(photo)
+    return {
+        'id': photo_id,
+        'filename': filename,
+        'url': url_prefix + filename,
+        'thumbnail_url': thumb_prefix + filename,
+        'created_at': created_at.isoformat(),
+        'size': file_size or 0,
+        'width': width or 0,
+        'height': height or 0
+    }
+
+def _encode_cursor(created_at, photo_id):
+    """Encode the (created_at, id) position of the last photo on a page"""
+    raw = f"{created_at.isoformat()}|{photo_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def _decode_cursor(cursor):
+    """Decode a cursor back into (created_at, id); raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, photo_id = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(created_at), int(photo_id)
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
 @gallery_bp.route('/api/photos', methods=['GET'])
 @login_required
 def api_gallery_photos():
-    """API endpoint for React frontend to get photos"""
-    page = request.args.get('page', 1, type=int)
+    """API endpoint for React frontend to get photos (keyset paginated)"""
+    cursor = request.args.get('cursor')
     per_page = request.args.get('per_page', 24, type=int)
+    include_total = request.args.get('include_total', 0, type=int)
     
     # Limit per_page to prevent abuse
-    per_page = min(per_page, 100)
-    
-    photos_q = Photo.query.filter_by(user_id=current_user.id).order_by(Photo.created_at.desc())
-    total = photos_q.count()
-    photos = photos_q.offset((page - 1) * per_page).limit(per_page).all()
-    
-    photo_data = []
-    for photo in photos:
-        photo_data.append({
-            'id': photo.id,
-            'filename': photo.filename,
-            'url': f'/uploads/users/{current_user.id}/{photo.filename}',
-            'thumbnail_url': f'/uploads/users/{current_user.id}/thumbs/{photo.filename}',
-            'created_at': photo.created_at.isoformat(),
-            'size': getattr(photo, 'size', 0),
-            'width': getattr(photo, 'width', 0),
-            'height': getattr(photo, 'height', 0)
-        })
+    per_page = max(1, min(per_page, 100))
     
-    return jsonify({
+    # Project only the columns the listing needs; rows skip ORM hydration
+    photos_q = db.session.query(
+        *(getattr(Photo, column) for column in _PHOTO_COLUMNS)
+    ).filter(Photo.user_id == current_user.id)
+    
+    # Seek past the last photo of the previous page instead of OFFSET
+    if cursor:
+        try:
+            last_created_at, last_id = _decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        photos_q = photos_q.filter(or_(
+            Photo.created_at < last_created_at,
+            and_(Photo.created_at == last_created_at, Photo.id < last_id)
+        ))
+    
+    # Fetch one extra row to know whether another page exists
+    photos = photos_q.order_by(Photo.created_at.desc(), Photo.id.desc()).limit(per_page + 1).all()
+    has_next = len(photos) > per_page
+    photos = photos[:per_page]
+    
+    url_prefix, thumb_prefix = _photo_url_prefixes(current_user.id)
+    photo_data = [_serialize_photo(photo, url_prefix, thumb_prefix) for photo in photos]
+    
+    response = {
         'photos': photo_data,
-        'total': total,
-        'page': page,
         'per_page': per_page,
-        'has_next': page * per_page < total,
-        'has_prev': page > 1,
-        'total_pages': (total + per_page - 1) // per_page
-    })
+        'has_next': has_next,
+        'next_cursor': _encode_cursor(photos[-1].created_at, photos[-1].id) if has_next else None
+    }
+    
+    # The total requires a COUNT over all of the user's photos, so it is opt-in
+    if include_total:
+        response['total'] = Photo.query.filter_by(user_id=current_user.id).count()
+    
+    return jsonify(response)
 
 @gallery_bp.route('/api/upload', methods=['POST'])
 @login_required
@@ -51,32 +121,47 @@ def api_upload_photo():
     if 'photos' not in request.files:
         return jsonify({'error': 'No photos provided'}), 400
     
-    files = request.files.getlist('photos')
+    files = [file for file in request.files.getlist('photos') if file.filename]
     uploaded_photos = []
     errors = []
     
-    for file in files:
-        if file.filename:
+    # Pillow verification/thumbnailing runs on worker threads so uploads overlap
+    app = current_app._get_current_object()
+    user_id = current_user.id
+    
+    def process_one(file):
+        with app.app_context():
             try:
-                filename = save_user_image(file, current_user.id)
-                if filename:
-                    # Save to database
-                    photo = Photo(
-                        filename=filename,
-                        user_id=current_user.id
-                    )
-                    db.session.add(photo)
-                    uploaded_photos.append({
-                        'filename': filename,
-                        'url': f'/uploads/users/{current_user.id}/{filename}',
-                        'thumbnail_url': f'/uploads/users/{current_user.id}/thumbs/{filename}'
-                    })
-                else:
-                    errors.append(f'Failed to process {file.filename}')
+                return save_user_image(file, user_id), None
             except Exception as e:
-                errors.append(f'Error uploading {file.filename}: {str(e)}')
+                return None, e
+    
+    with ThreadPoolExecutor(max_workers=min(len(files), 8) or 1) as pool:
+        results = list(pool.map(process_one, files))
     
-    if uploaded_photos:
+    url_prefix, thumb_prefix = _photo_url_prefixes(user_id)
+    photo_rows = []
+    for file, (meta, error) in zip(files, results):
+        if error is not None:
+            errors.append(f'Error uploading {file.filename}: {str(error)}')
+        elif meta:
+            photo_rows.append(dict(meta, user_id=user_id))
+            filename = meta['stored_filename']
+            uploaded_photos.append({
+                'filename': filename,
+                'url': url_prefix + filename,
+                'thumbnail_url': thumb_prefix + filename
+            })
+        else:
+            errors.append(f'Failed to process {file.filename}')
+    
+    if photo_rows:
+        # Save to database with one executemany INSERT, bypassing ORM unit-of-work
+        db.session.execute(Photo.__table__.insert(), photo_rows)
+        adjust_photo_counters(
+            db.session.connection(), user_id,
+            len(photo_rows), sum(row['file_size'] or 0 for row in photo_rows)
+        )
         db.session.commit()
     
     return jsonify({
@@ -90,27 +175,18 @@ def api_upload_photo():
 @login_required
 def api_get_photo(photo_id):
     """Get single photo details"""
-    photo = Photo.query.filter_by(id=photo_id, user_id=current_user.id).first_or_404()
+    photo = _get_owned_photo_or_404(photo_id)
     
-    return jsonify({
-        'id': photo.id,
-        'filename': photo.filename,
-        'url': f'/uploads/users/{current_user.id}/{photo.filename}',
-        'thumbnail_url': f'/uploads/users/{current_user.id}/thumbs/{photo.filename}',
-        'created_at': photo.created_at.isoformat(),
-        'size': getattr(photo, 'size', 0),
-        'width': getattr(photo, 'width', 0),
-        'height': getattr(photo, 'height', 0)
-    })
+    return jsonify(_serialize_photo(photo, *_photo_url_prefixes(current_user.id)))
 
 @gallery_bp.route('/api/photos/<int:photo_id>', methods=['DELETE'])
 @login_required
 def api_delete_photo(photo_id):
     """Delete a photo"""
-    photo = Photo.query.filter_by(id=photo_id, user_id=current_user.id).first_or_404()
+    photo = _get_owned_photo_or_404(photo_id)
     
     # Delete files from disk
-    success = delete_user_image(photo.filename, current_user.id)
+    success = delete_user_image(photo.stored_filename, current_user.id)
     
     # Delete from database
     db.session.delete(photo)
@@ -134,28 +210,41 @@ def api_bulk_delete_photos():
     if not isinstance(photo_ids, list):
         return jsonify({'error': 'photo_ids must be a list'}), 400
     
-    # Get photos belonging to current user
-    photos = Photo.query.filter(
+    # Stream (id, filename) pairs of photos belonging to current user in chunks
+    rows = db.session.query(Photo.id, Photo.stored_filename, Photo.file_size).filter(
         Photo.id.in_(photo_ids),
         Photo.user_id == current_user.id
-    ).all()
+    ).yield_per(500)
+    owned_ids = []
+    filenames = []
+    freed_size = 0
+    for photo_id, stored_filename, file_size in rows:
+        owned_ids.append(photo_id)
+        filenames.append(stored_filename)
+        freed_size += file_size or 0
     
     deleted_count = 0
     errors = []
     
-    for photo in photos:
+    if owned_ids:
+        # Delete from database with a single statement
         try:
-            # Delete files from disk
-            delete_user_image(photo.filename, current_user.id)
-            
-            # Delete from database
-            db.session.delete(photo)
-            deleted_count += 1
+            deleted_count = Photo.query.filter(
+                Photo.id.in_(owned_ids)
+            ).delete(synchronize_session=False)
+            adjust_photo_counters(db.session.connection(), current_user.id, -deleted_count, -freed_size)
+            db.session.commit()
         except Exception as e:
-            errors.append(f'Error deleting photo {photo.id}: {str(e)}')
-    
-    if deleted_count > 0:
-        db.session.commit()
+            db.session.rollback()
+            return jsonify({'error': f'Error deleting photos: {str(e)}'}), 500
+        
+        # Delete files from disk in parallel; workers have no app context
+        user_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], str(current_user.id))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = pool.map(lambda name: remove_image_files(user_dir, name), filenames)
+            for photo_id, removed in zip(owned_ids, results):
+                if not removed:
+                    errors.append(f'Error deleting files for photo {photo_id}')
     
     return jsonify({
         'success': deleted_count > 0,
@@ -168,13 +257,9 @@ def api_bulk_delete_photos():
 @login_required
 def api_gallery_stats():
     """Get gallery statistics"""
-    total_photos = Photo.query.filter_by(user_id=current_user.id).count()
-    
-    # Calculate total size if you have size field
-    total_size = 0
-    if hasattr(Photo, 'size'):
-        result = db.session.query(func.sum(Photo.size)).filter_by(user_id=current_user.id).scalar()
-        total_size = result or 0
+    # Counters are maintained on the user row, so no COUNT/SUM is needed
+    total_photos = current_user.photo_count or 0
+    total_size = current_user.photo_total_size or 0
     
     return jsonify({
         'total_photos': total_photos,
@@ -0,0 +1,62 @@
+# json_provider.py
+import datetime
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+
+# Non-str keys show up in debug payloads keyed by project ID. Naive
+# datetimes stay untagged, matching the isoformat() strings to_dict() returns
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def _default(o):
+    # Only reached for datetimes on the stdlib fallback path; keep the same
+    # ISO 8601 output orjson produces instead of Flask's HTTP date format
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+def dumps_bytes(obj):
+    """Encode obj to JSON bytes, for hand-assembled (e.g. streamed) responses"""
+    if orjson is None:
+        return json.dumps(obj, default=_default).encode('utf-8')
+    return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson when it is installed.
+
+    Responses are encoded straight to bytes without the str round-trip.
+    Keys are not sorted. Datetimes (e.g. in column projections) are emitted
+    as ISO 8601, exactly like datetime.isoformat(); anything else orjson
+    can't handle goes through Flask's default hook (dates, decimals, UUIDs,
+    dataclasses).
+    """
+    sort_keys = False
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS),
+            mimetype=self.mimetype
+        )
@@ -0,0 +1,79 @@
+# log_buffer.py
+import datetime
+import logging
+import threading
+
+from models import ProjectLog
+
+log = logging.getLogger(__name__)
+
+# Pushed log lines waiting to be inserted
+# Structure: [{'project_id', 'log_type', 'content', 'timestamp'}, ...]
+_pending = []
+_lock = threading.Lock()
+
+# Flush at least this often, or as soon as this many lines are waiting
+FLUSH_INTERVAL = 0.1  # seconds
+FLUSH_SIZE = 100
+
+# A batch that fails this many flushes in a row is dropped, so one bad row
+# can't block every later flush while the buffer keeps growing. Flushes run
+# from WSGI threads and the periodic task, so the count is guarded by _lock
+MAX_FLUSH_ATTEMPTS = 5
+_failed_flushes = 0
+
+def add(project_id: int, log_type: str, content: str) -> bool:
+    """
+    Queue a log line for insertion
+
+    Returns:
+        True if the buffer has reached FLUSH_SIZE and should be flushed now
+    """
+    row = {
+        'project_id': project_id,
+        'log_type': log_type,
+        'content': content,
+        'timestamp': datetime.datetime.utcnow()
+    }
+    with _lock:
+        _pending.append(row)
+        return len(_pending) >= FLUSH_SIZE
+
+def has_pending() -> bool:
+    """True if there are log lines waiting to be flushed"""
+    return bool(_pending)
+
+def flush(connection) -> int:
+    """
+    Insert every queued log line with one executemany INSERT
+
+    Args:
+        connection: SQLAlchemy connection inside a transaction
+
+    Returns:
+        Number of rows inserted
+    """
+    global _failed_flushes
+    with _lock:
+        if not _pending:
+            return 0
+        batch = _pending[:]
+        _pending.clear()
+
+    try:
+        connection.execute(ProjectLog.__table__.insert(), batch)
+    except Exception as e:
+        with _lock:
+            _failed_flushes += 1
+            dropped = _failed_flushes >= MAX_FLUSH_ATTEMPTS
+            if dropped:
+                _failed_flushes = 0
+            else:
+                # Put the lines back (ahead of anything queued since) for the next flush
+                _pending[:0] = batch
+        if dropped:
+            log.error(f"Dropping {len(batch)} log lines after {MAX_FLUSH_ATTEMPTS} failed flushes: {e}")
+        raise
+    with _lock:
+        _failed_flushes = 0
+    return len(batch)
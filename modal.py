@@ -2,40 +2,51 @@
 from flask import Flask
 import datetime
 from models import db
-from firewall_models import FirewallRule
+from firewall_models import FirewallRule, ensure_firewall_rule_index
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
 import os
 
 # Get the path to the database file
 INSTANCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
 DATABASE_PATH = os.path.join(INSTANCE_FOLDER, 'app.db')
 
-# Create a minimal Flask app
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DATABASE_PATH}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Initialize the database with the app
-db.init_app(app)
-
-# Use the application context
-with app.app_context():
-    # Create a new firewall rule
-    rule = FirewallRule(
-        project_id=1,  # Your project ID
-        rule_type='path',
-        value='/admin',
-        description='Block admin access',
-        created_at=datetime.datetime.now(datetime.UTC)  # Use timezone-aware datetime
-    )
-
-    # Add and commit to database
-    db.session.add(rule)
-    db.session.commit()
-    
-    print("Firewall rule added successfully!")
-    
-    # Verify the rule was added
-    rules = FirewallRule.query.filter_by(project_id=1).all()
-    print(f"Found {len(rules)} firewall rules for project 1:")
-    for r in rules:
-        print(f"  - ID: {r.id}, Type: {r.rule_type}, Value: {r.value}")
\ No newline at end of file
+def main():
+    # Create a minimal Flask app
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DATABASE_PATH}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Initialize the database with the app
+    db.init_app(app)
+
+    # Use the application context
+    with app.app_context():
+        # The upsert below needs the unique rule index
+        with db.engine.begin() as connection:
+            ensure_firewall_rule_index(connection)
+
+        # Create a new firewall rule (no-op if it already exists)
+        stmt = insert(FirewallRule).values(
+            project_id=1,  # Your project ID
+            rule_type='path',
+            value='/admin',
+            description='Block admin access',
+            created_at=datetime.datetime.now(datetime.UTC)  # Use timezone-aware datetime
+        ).on_conflict_do_nothing(index_elements=['project_id', 'rule_type', 'value'])
+
+        # Execute and commit to database
+        result = db.session.execute(stmt)
+        db.session.commit()
+
+        if result.rowcount:
+            print("Firewall rule added successfully!")
+        else:
+            print("Firewall rule already exists.")
+
+        # Verify the rule count
+        count = db.session.query(func.count(FirewallRule.id)).filter_by(project_id=1).scalar()
+        print(f"Found {count} firewall rules for project 1")
+
+if __name__ == '__main__':
+    main()
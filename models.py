@@ -2,11 +2,31 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
+import time
 from PIL import Image
 import os, secrets
-from sqlalchemy import UniqueConstraint
+import sqlite3
+from sqlalchemy import UniqueConstraint, event
+from sqlalchemy.engine import Engine
 db = SQLAlchemy()
 
+# Applies to every engine in the process (Flask-SQLAlchemy, the proxy session,
+# the firewall lookups). WAL lets readers run while an upload or heartbeat is
+# writing; synchronous=NORMAL is durable enough in WAL mode. SQLite leaves
+# foreign keys off per connection, and the ON DELETE CASCADE / SET NULL
+# clauses (User.photos relies on them via passive_deletes) need them on.
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MB
+    cursor.close()
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -20,6 +40,10 @@ class User(UserMixin, db.Model):
     website = db.Column(db.String(200))
     profile_image = db.Column(db.String(255), default='default.png')  # Make sure this has default
     
+    # Denormalized gallery counters, kept in sync by adjust_photo_counters()
+    photo_count = db.Column(db.Integer, default=0, nullable=False)
+    photo_total_size = db.Column(db.BigInteger, default=0, nullable=False)
+    
     def set_password(self, password):
         """Set password hash"""
         self.password_hash = generate_password_hash(password)
@@ -69,7 +93,7 @@ class User(UserMixin, db.Model):
     
 class Photo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     stored_filename = db.Column(db.String(255), nullable=False, unique=True)
     thumb_filename = db.Column(db.String(255), nullable=True)
@@ -77,10 +101,16 @@ class Photo(db.Model):
     width = db.Column(db.Integer)
     height = db.Column(db.Integer)
     file_size = db.Column(db.Integer)  # bytes
-    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     is_public = db.Column(db.Boolean, default=False, nullable=False)
     caption = db.Column(db.String(255), nullable=True)
-    user = db.relationship('User', backref=db.backref('photos', lazy='dynamic', cascade='all, delete-orphan'))
+    # Loading a user's photos implicitly raises; query them explicitly or use selectinload(User.photos)
+    user = db.relationship('User', backref=db.backref('photos', lazy='raise_on_sql', cascade='all, delete-orphan', passive_deletes=True))
+
+    __table_args__ = (
+        # Serves the per-user gallery listing as an ordered range scan
+        db.Index('ix_photo_user_created', 'user_id', created_at.desc(), 'id'),
+    )
 
     def thumb_url(self):
         return f'uploads/{self.user_id}/{self.thumb_filename}' if self.thumb_filename else None
@@ -89,6 +119,94 @@ class Photo(db.Model):
         return f'uploads/{self.user_id}/{self.stored_filename}'
 
 
+def adjust_photo_counters(connection, user_id, count_delta, size_delta):
+    """Apply a delta to a user's photo counters in a single UPDATE"""
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id == user_id)
+        .values(
+            photo_count=users.c.photo_count + count_delta,
+            photo_total_size=users.c.photo_total_size + size_delta
+        )
+    )
+
+# Keep counters in sync for ORM-level inserts/deletes; bulk paths call adjust_photo_counters directly
+@event.listens_for(Photo, 'after_insert')
+def _photo_after_insert(mapper, connection, target):
+    adjust_photo_counters(connection, target.user_id, 1, target.file_size or 0)
+
+@event.listens_for(Photo, 'after_delete')
+def _photo_after_delete(mapper, connection, target):
+    adjust_photo_counters(connection, target.user_id, -1, -(target.file_size or 0))
+
+
+def backfill_photo_counters(connection):
+    """Recompute every user's photo counters from the photo table"""
+    connection.exec_driver_sql(
+        'UPDATE "user" SET '
+        'photo_count = (SELECT COUNT(*) FROM photo WHERE photo.user_id = "user".id), '
+        'photo_total_size = (SELECT COALESCE(SUM(file_size), 0) FROM photo WHERE photo.user_id = "user".id)'
+    )
+
+def _has_column(connection, table, column):
+    return any(row[1] == column for row in connection.exec_driver_sql(f'PRAGMA table_info("{table}")'))
+
+def upgrade_schema(connection):
+    """
+    Bring a database created by an older version up to date. create_all()
+    only creates missing tables, so columns and indexes added to existing
+    tables are created in here (and backfilled) at startup.
+    """
+    added_counters = False
+    if not _has_column(connection, 'user', 'photo_count'):
+        connection.exec_driver_sql('ALTER TABLE "user" ADD COLUMN photo_count INTEGER NOT NULL DEFAULT 0')
+        added_counters = True
+    if not _has_column(connection, 'user', 'photo_total_size'):
+        connection.exec_driver_sql('ALTER TABLE "user" ADD COLUMN photo_total_size BIGINT NOT NULL DEFAULT 0')
+        added_counters = True
+    if added_counters:
+        backfill_photo_counters(connection)
+
+    if not _has_column(connection, 'agents', 'last_heartbeat_ts'):
+        connection.exec_driver_sql('ALTER TABLE agents ADD COLUMN last_heartbeat_ts BIGINT')
+        # DateTime values are stored as naive UTC text, which strftime parses
+        connection.exec_driver_sql(
+            "UPDATE agents SET last_heartbeat_ts = CAST(strftime('%s', last_heartbeat) AS INTEGER) "
+            "WHERE last_heartbeat IS NOT NULL"
+        )
+
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_photo_user_created ON photo (user_id, created_at DESC, id)'
+    )
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_projectlog_project_ts ON project_logs (project_id, timestamp)'
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_cmd_agent_pending ON commands (agent_id) WHERE status = 'pending'"
+    )
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_projects_status ON projects (status)')
+    _ensure_unique_tunnel_port(connection)
+
+def _ensure_unique_tunnel_port(connection):
+    """
+    Make ix_projects_tunnel_port a unique index. Where earlier versions
+    handed out a port twice, the oldest project keeps it and the others
+    lose theirs (a new one is assigned the next time they are made public).
+    """
+    for row in connection.exec_driver_sql('PRAGMA index_list(projects)').fetchall():
+        if row[1] == 'ix_projects_tunnel_port':
+            if row[2]:
+                return
+            connection.exec_driver_sql('DROP INDEX ix_projects_tunnel_port')
+            break
+    connection.exec_driver_sql(
+        'UPDATE projects SET tunnel_port = NULL WHERE tunnel_port IS NOT NULL AND id NOT IN '
+        '(SELECT MIN(id) FROM projects WHERE tunnel_port IS NOT NULL GROUP BY tunnel_port)'
+    )
+    connection.exec_driver_sql('CREATE UNIQUE INDEX ix_projects_tunnel_port ON projects (tunnel_port)')
+
+
 class Repo(db.Model):
     __tablename__ = "repos"
     id = db.Column(db.Integer, primary_key=True)
@@ -121,12 +239,12 @@ class Repo(db.Model):
     def is_starred_by(self, user):
         if not user or not user.is_authenticated:
             return False
-        return RepoStar.query.filter_by(repo_id=self.id, user_id=user.id).first() is not None
+        return db.session.query(RepoStar.query.filter_by(repo_id=self.id, user_id=user.id).exists()).scalar()
 
     def is_forked_by(self, user):
         if not user or not user.is_authenticated:
             return False
-        return RepoFork.query.filter_by(repo_id=self.id, user_id=user.id).first() is not None
+        return db.session.query(RepoFork.query.filter_by(repo_id=self.id, user_id=user.id).exists()).scalar()
 
 class RepoFile(db.Model):
     __tablename__ = "repo_files"
@@ -206,6 +324,21 @@ class RepoIssue(db.Model):
 
 # Add to models.py (after your existing models)
 
+# An agent counts as online for this long after its last stored heartbeat
+AGENT_HEARTBEAT_TTL = 120  # 2 minutes
+
+def agent_status(status, last_heartbeat_ts):
+    """
+    Effective status of a stored agent row. 'online' only holds while the
+    persisted heartbeat is within AGENT_HEARTBEAT_TTL, so every worker (and
+    one that just restarted) gives the same answer without waiting for the
+    expiry UPDATE.
+    """
+    if status == 'online' and (last_heartbeat_ts is None or
+                               last_heartbeat_ts <= time.time() - AGENT_HEARTBEAT_TTL):
+        return 'offline'
+    return status
+
 class Agent(db.Model):
     __tablename__ = "agents"
     id = db.Column(db.Integer, primary_key=True)
@@ -214,21 +347,33 @@ class Agent(db.Model):
     api_key = db.Column(db.String(255), unique=True, nullable=False)
     status = db.Column(db.String(20), default='offline')  # online, offline
     last_heartbeat = db.Column(db.DateTime)
+    last_heartbeat_ts = db.Column(db.BigInteger)  # Epoch seconds of last_heartbeat
     system_info = db.Column(db.JSON)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     
     user = db.relationship('User', backref=db.backref('agents', lazy='dynamic', cascade='all, delete-orphan'))
+    # Never loaded implicitly; query Project by agent_id instead
+    projects = db.relationship('Project', back_populates='agent', foreign_keys='Project.agent_id', lazy='raise')
+    
+    @property
+    def current_status(self):
+        return agent_status(self.status, self.last_heartbeat_ts)
     
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
-            'status': self.status,
+            'status': self.current_status,
             'last_heartbeat': self.last_heartbeat.isoformat() if self.last_heartbeat else None,
+            'last_heartbeat_ts': self.last_heartbeat_ts,
             'system_info': self.system_info,
             'created_at': self.created_at.isoformat()
         }
 
+def project_public_url(subdomain):
+    """Public URL for a project's subdomain, or None if it has none"""
+    return f"https://{subdomain}.YOURDOMAIN.com" if subdomain else None
+
 class Project(db.Model):
     __tablename__ = "projects"
     id = db.Column(db.Integer, primary_key=True)
@@ -239,12 +384,13 @@ class Project(db.Model):
     description = db.Column(db.Text)
     command = db.Column(db.String(500), default='npm run dev')
     port = db.Column(db.Integer)
-    status = db.Column(db.String(20), default='stopped')
+    status = db.Column(db.String(20), default='stopped', index=True)
     pid = db.Column(db.Integer)
     pending_action = db.Column(db.String(20), nullable=True)  # ✅ Already exists
     
     # ✅ ADD THIS LINE:
-    tunnel_port = db.Column(db.Integer, nullable=True)  # Port for tunnel server (10000-20000 range)
+    # Unique: the allocator in tunnel_ports.py only proposes, this index decides
+    tunnel_port = db.Column(db.Integer, nullable=True, unique=True, index=True)  # Port for tunnel server (10000-20000 range)
     
     last_started = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
@@ -254,7 +400,7 @@ class Project(db.Model):
     
     # Relationships
     user = db.relationship('User', backref=db.backref('projects', lazy='dynamic', cascade='all, delete-orphan'))
-    agent = db.relationship('Agent', backref=db.backref('projects', lazy='dynamic'), foreign_keys=[agent_id])
+    agent = db.relationship('Agent', back_populates='projects', foreign_keys=[agent_id])
     
     def to_dict(self):
         return {
@@ -268,11 +414,11 @@ class Project(db.Model):
             'pid': self.pid,
             'agent_id': self.agent_id,
             'agent_name': self.agent.name if self.agent else None,
-            'agent_status': self.agent.status if self.agent else None,
+            'agent_status': self.agent.current_status if self.agent else None,
             'is_public': self.is_public,
             'subdomain': self.subdomain,
             'tunnel_port': self.tunnel_port,  # ✅ ADD THIS
-            'url': f"https://{self.subdomain}.YOURDOMAIN.com" if self.subdomain else None,
+            'url': project_public_url(self.subdomain),
             'last_started': self.last_started.isoformat() if self.last_started else None,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
@@ -295,6 +441,16 @@ class Command(db.Model):
     agent = db.relationship('Agent', backref=db.backref('commands', lazy='dynamic', cascade='all, delete-orphan'))
     project = db.relationship('Project', backref=db.backref('commands', lazy='dynamic', cascade='all, delete-orphan'))
     
+    __table_args__ = (
+        # Agents poll for their pending commands constantly; completed ones are
+        # the bulk of the table and stay out of this partial index
+        db.Index(
+            'ix_cmd_agent_pending', 'agent_id',
+            sqlite_where=db.text("status = 'pending'"),
+            postgresql_where=db.text("status = 'pending'")
+        ),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -312,10 +468,15 @@ class ProjectLog(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False)
     log_type = db.Column(db.String(20))  # stdout, stderr
     content = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     
     project = db.relationship('Project', backref=db.backref('logs', lazy='dynamic', cascade='all, delete-orphan'))
     
+    __table_args__ = (
+        # Newest-N-logs-for-a-project is an index range scan, no sort
+        db.Index('ix_projectlog_project_ts', 'project_id', 'timestamp'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
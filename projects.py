@@ -1,28 +1,199 @@
 # projects.py - Updated to match your frontend
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
 from flask_login import login_required, current_user
-from models import db, Project, Agent, Command, ProjectLog
+from models import db, Project, Agent, Command, ProjectLog, agent_status, project_public_url
+from json_provider import dumps_bytes
+from sqlalchemy import bindparam, literal, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, raiseload
+from werkzeug.exceptions import HTTPException
+import agent_presence
+import log_buffer
+import tunnel_ports
 import logging
-from datetime import datetime, timedelta
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import random
 import secrets
+import time
 
 logger = logging.getLogger(__name__)
 
 projects_bp = Blueprint('projects', __name__)
 
+# Agent lookup by API key, built once so its compiled form stays cached
+_AGENT_BY_API_KEY = select(Agent).where(Agent.api_key == bindparam('api_key'))
+
+def get_agent_by_api_key(api_key):
+    """Return the Agent owning api_key, or None"""
+    return db.session.execute(_AGENT_BY_API_KEY, {'api_key': api_key}).scalar_one_or_none()
+
+# Resolved agent API keys, keyed by a digest so raw keys aren't kept around
+# Structure: {digest: (AgentRef, expires_at)}
+AgentRef = namedtuple('AgentRef', ['id'])
+_agent_key_cache = {}
+AGENT_KEY_CACHE_TTL = 60  # seconds
+AGENT_KEY_CACHE_MAX = 10000
+
+# Tries at a unique subdomain (base name, then random suffixes)
+SUBDOMAIN_ATTEMPTS = 5
+
+# Tries at a tunnel port the unique index accepts (another worker may have
+# assigned the one this process proposed)
+TUNNEL_PORT_ATTEMPTS = 5
+
+def _api_key_digest(api_key):
+    return hashlib.blake2b(api_key.encode('utf-8'), digest_size=16).digest()
+
+def cached_agent_ref(api_key):
+    """Return the cached AgentRef for api_key without touching the database, or None"""
+    cached = _agent_key_cache.get(_api_key_digest(api_key))
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+def resolve_agent_api_key(api_key):
+    """Return an AgentRef for api_key (cached for a minute), or None"""
+    ref = cached_agent_ref(api_key)
+    if ref is not None:
+        return ref
+    
+    digest = _api_key_digest(api_key)
+    agent_id = db.session.query(Agent.id).filter(Agent.api_key == api_key).scalar()
+    if agent_id is None:
+        _agent_key_cache.pop(digest, None)
+        return None
+    
+    if len(_agent_key_cache) >= AGENT_KEY_CACHE_MAX:
+        _agent_key_cache.clear()
+    ref = AgentRef(agent_id)
+    _agent_key_cache[digest] = (ref, time.monotonic() + AGENT_KEY_CACHE_TTL)
+    return ref
+
+def forget_agent_api_keys(agent_id):
+    """Drop cached API key lookups for an agent (deleted or key changed)"""
+    for digest, (ref, _) in list(_agent_key_cache.items()):
+        if ref.id == agent_id:
+            _agent_key_cache.pop(digest, None)
+
+# Columns for the project list, mirroring Project.to_dict() without hydrating models
+_PROJECT_LIST_COLUMNS = (
+    Project.id, Project.name, Project.path, Project.description, Project.command,
+    Project.port, Project.status, Project.pid, Project.agent_id,
+    Agent.name.label('agent_name'), Agent.status.label('agent_status'),
+    Agent.last_heartbeat_ts.label('agent_heartbeat_ts'),
+    Project.is_public, Project.subdomain, Project.tunnel_port,
+    Project.last_started, Project.created_at, Project.updated_at
+)
+
+# Agents poll this constantly with the same shape; built once so the compiled
+# statement is reused from the cache instead of rebuilding the query per poll
+_PENDING_COMMANDS = select(
+    Command.id.label('command_id'), Command.action,
+    Command.status.label('command_status'), Command.result,
+    Command.created_at.label('command_created_at'),
+    *_PROJECT_LIST_COLUMNS
+).select_from(Command).join(
+    Project, Command.project_id == Project.id
+).outerjoin(
+    Agent, Project.agent_id == Agent.id
+).where(
+    Command.agent_id == bindparam('agent_id'),
+    Command.status == 'pending'
+)
+
+def _owned_project(project_id, *columns):
+    """
+    Fetch columns (default: just the id) of one of the current user's
+    projects as a Row, aborting with 404 if it isn't theirs (callers with a
+    catch-all except must let HTTPException through)
+    """
+    row = db.session.execute(
+        select(*(columns or (Project.id,))).where(
+            Project.id == project_id,
+            Project.user_id == current_user.id
+        )
+    ).one_or_none()
+    if row is None:
+        abort(404)
+    return row
+
+def _project_dicts(*criteria):
+    """Yield Project.to_dict()-shaped dicts for projects matching criteria"""
+    rows = db.session.query(*_PROJECT_LIST_COLUMNS).outerjoin(
+        Agent, Project.agent_id == Agent.id
+    ).filter(*criteria)
+    for row in rows:
+        yield _project_row_dict(row._asdict())
+
+def _project_row_dict(project):
+    """Finish a row dict built from _PROJECT_LIST_COLUMNS"""
+    project['agent_status'] = agent_status(project['agent_status'], project.pop('agent_heartbeat_ts'))
+    project['url'] = project_public_url(project['subdomain'])
+    return project
+
+# Encoded GET /api/projects/<id> bodies, reused until the project row or its
+# agent's status changes
+# Structure: {project_id: ((updated_at, agent_name, agent_status), bytes)}
+_project_payload_cache = {}
+PROJECT_PAYLOAD_CACHE_MAX = 1000
+
+def _project_payload(project):
+    """Return the encoded {'success', 'project'} body for a loaded Project"""
+    agent = project.agent
+    version = (project.updated_at, agent.name if agent else None, agent.current_status if agent else None)
+    cached = _project_payload_cache.get(project.id)
+    if cached and cached[0] == version:
+        return cached[1]
+    
+    body = dumps_bytes({'success': True, 'project': project.to_dict()})
+    if len(_project_payload_cache) >= PROJECT_PAYLOAD_CACHE_MAX:
+        _project_payload_cache.clear()
+    _project_payload_cache[project.id] = (version, body)
+    return body
+
+def _queue_project_command(project_id, action, new_status, *conditions):
+    """
+    Move one of the current user's projects to new_status and queue `action`
+    for its agent, guarded by conditions, in a single transaction.
+    Returns False (and changes nothing) if no project matched.
+    """
+    updated = Project.query.filter(
+        Project.id == project_id,
+        Project.user_id == current_user.id,
+        *conditions
+    ).update({'status': new_status}, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        return False
+    
+    db.session.execute(Command.__table__.insert().from_select(
+        ['agent_id', 'project_id', 'action', 'status', 'created_at'],
+        select(
+            Project.agent_id, Project.id, literal(action), literal('pending'), literal(datetime.utcnow())
+        ).where(Project.id == project_id)
+    ))
+    db.session.commit()
+    return True
+
 # ============================================
 # AGENT MANAGEMENT
 # ============================================
 
+def _used_tunnel_ports():
+    """Ports already assigned to projects, read once to seed the allocator"""
+    return [port for (port,) in db.session.query(Project.tunnel_port).filter(
+        Project.tunnel_port.isnot(None)
+    ).distinct()]
+
 def find_available_tunnel_port():
-    """Find an available port for tunnel (range 10000-20000)"""
-    used_ports = set(p.tunnel_port for p in Project.query.filter(Project.tunnel_port.isnot(None)).all())
-    
-    for port in range(10000, 20000):
-        if port not in used_ports:
-            return port
-    
-    raise Exception("No available tunnel ports")
+    """Reserve the lowest available port for tunnel (range 10000-20000)"""
+    return tunnel_ports.allocate(_used_tunnel_ports)
+
+def _is_tunnel_port_conflict(error):
+    """Whether an IntegrityError came from the unique index on tunnel_port"""
+    return 'tunnel_port' in str(error.orig)
 
 @projects_bp.route('/api/agents', methods=['GET'])
 @login_required
@@ -31,15 +202,8 @@ def get_agents():
     try:
         agents = Agent.query.filter_by(user_id=current_user.id).all()
         
-        # Mark agents as offline if no heartbeat in last 2 minutes
-        for agent in agents:
-            if agent.last_heartbeat:
-                time_diff = datetime.utcnow() - agent.last_heartbeat
-                if time_diff > timedelta(minutes=2):
-                    agent.status = 'offline'
-        
-        db.session.commit()
-        
+        # to_dict() derives the status from the stored heartbeat, the same
+        # way /api/projects does, so listing agents never writes
         return jsonify({
             'success': True,
             'agents': [agent.to_dict() for agent in agents]
@@ -105,7 +269,7 @@ def get_agent_info():
     if not api_key:
         return jsonify({'error': 'Missing API key'}), 401
     
-    agent = Agent.query.filter_by(api_key=api_key).first()
+    agent = get_agent_by_api_key(api_key)
     
     if not agent:
         logger.error(f"No agent found for API key: {api_key[:10]}...")
@@ -116,7 +280,7 @@ def get_agent_info():
     return jsonify({
         'id': agent.id,
         'name': agent.name,
-        'status': agent.status,
+        'status': agent.current_status,
         'last_heartbeat': agent.last_heartbeat.isoformat() if agent.last_heartbeat else None
     }), 200
 
@@ -146,6 +310,8 @@ def delete_agent(agent_id):
         
         db.session.delete(agent)
         db.session.commit()
+        agent_presence.mark_offline(agent_id)
+        forget_agent_api_keys(agent_id)
         
         logger.info(f"Agent deleted: {agent.name}")
         
@@ -171,10 +337,11 @@ def delete_agent(agent_id):
 def get_projects():
     """Get all projects for current user"""
     try:
-        projects = Project.query.filter_by(user_id=current_user.id).all()
+        projects = list(_project_dicts(Project.user_id == current_user.id))
+        
         return jsonify({
             'success': True,
-            'projects': [project.to_dict() for project in projects]
+            'projects': projects
         }), 200
     except Exception as e:
         logger.error(f"Error fetching projects: {str(e)}")
@@ -188,15 +355,12 @@ def get_projects():
 def get_project(project_id):
     """Get single project"""
     try:
-        project = Project.query.filter_by(
+        project = Project.query.options(joinedload(Project.agent)).filter_by(
             id=project_id,
             user_id=current_user.id
         ).first_or_404()
         
-        return jsonify({
-            'success': True,
-            'project': project.to_dict()
-        }), 200
+        return Response(_project_payload(project), status=200, mimetype='application/json')
     except Exception as e:
         logger.error(f"Error fetching project: {str(e)}")
         return jsonify({
@@ -264,7 +428,7 @@ def create_project():
 def update_project(project_id):
     """Update project"""
     try:
-        project = Project.query.filter_by(
+        project = Project.query.options(joinedload(Project.agent)).filter_by(
             id=project_id,
             user_id=current_user.id
         ).first_or_404()
@@ -315,8 +479,12 @@ def delete_project(project_id):
             )
             db.session.add(command)
         
+        tunnel_port = project.tunnel_port
         db.session.delete(project)
         db.session.commit()
+        _project_payload_cache.pop(project_id, None)
+        if tunnel_port:
+            tunnel_ports.release(tunnel_port)
         
         logger.info(f"Project deleted: {project.name}")
         
@@ -343,45 +511,40 @@ def start_project(project_id):
     print("=== START PROJECT ROUTE CALLED ===")
     """Send start command to agent"""
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
+        project = _owned_project(project_id, Project.agent_id)
         
         # Check if agent is online
-        if not project.agent or project.agent.status != 'online':
+        if not project.agent_id or not agent_presence.is_online(project.agent_id):
             return jsonify({
                 'success': False,
                 'message': 'Agent is offline. Please start the agent first.'
             }), 400
         
-        # Check if already running
-        if project.status == 'running':
+        # The status/agent checks are part of the UPDATE, so two concurrent
+        # starts can't both queue a command
+        queued = _queue_project_command(
+            project_id, 'start', 'starting',
+            Project.status != 'running',
+            Project.agent_id == project.agent_id
+        )
+        
+        if not queued:
             return jsonify({
                 'success': False,
                 'message': 'Project is already running'
             }), 400
         
-        # Create command
-        command = Command(
-            agent_id=project.agent_id,
-            project_id=project.id,
-            action='start',
-            status='pending'
-        )
-        db.session.add(command)
-        
-        project.status = 'starting'
-        db.session.commit()
-        
-        logger.info(f"Start command queued for project: {project.name}")
+        project = next(_project_dicts(Project.id == project_id))
+        logger.info(f"Start command queued for project: {project['name']}")
         
         return jsonify({
             'success': True,
             'message': 'Start command sent to agent',
-            'project': project.to_dict()
+            'project': project
         }), 200
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error starting project: {str(e)}")
@@ -395,37 +558,30 @@ def start_project(project_id):
 def stop_project(project_id):
     """Send stop command to agent"""
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
+        queued = _queue_project_command(
+            project_id, 'stop', 'stopping',
+            Project.status.in_(('running', 'starting'))
+        )
         
-        if project.status not in ['running', 'starting']:
+        if not queued:
+            _owned_project(project_id)
+            
             return jsonify({
                 'success': False,
                 'message': 'Project is not running'
             }), 400
         
-        # Create command
-        command = Command(
-            agent_id=project.agent_id,
-            project_id=project.id,
-            action='stop',
-            status='pending'
-        )
-        db.session.add(command)
-        
-        project.status = 'stopping'
-        db.session.commit()
-        
-        logger.info(f"Stop command queued for project: {project.name}")
+        project = next(_project_dicts(Project.id == project_id))
+        logger.info(f"Stop command queued for project: {project['name']}")
         
         return jsonify({
             'success': True,
             'message': 'Stop command sent to agent',
-            'project': project.to_dict()
+            'project': project
         }), 200
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error stopping project: {str(e)}")
@@ -439,38 +595,36 @@ def stop_project(project_id):
 def restart_project(project_id):
     """Send restart command to agent"""
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
-        
-        # Check if agent is online
-        if not project.agent or project.agent.status != 'online':
+        project = _owned_project(project_id, Project.agent_id)
+        if not project.agent_id or not agent_presence.is_online(project.agent_id):
             return jsonify({
                 'success': False,
                 'message': 'Agent is offline'
             }), 400
         
-        # Create command
-        command = Command(
-            agent_id=project.agent_id,
-            project_id=project.id,
-            action='restart',
-            status='pending'
+        # Guard on the agent checked above, in case it was changed meanwhile
+        queued = _queue_project_command(
+            project_id, 'restart', 'restarting',
+            Project.agent_id == project.agent_id
         )
-        db.session.add(command)
         
-        project.status = 'restarting'
-        db.session.commit()
+        if not queued:
+            return jsonify({
+                'success': False,
+                'message': 'Agent is offline'
+            }), 400
         
-        logger.info(f"Restart command queued for project: {project.name}")
+        project = next(_project_dicts(Project.id == project_id))
+        logger.info(f"Restart command queued for project: {project['name']}")
         
         return jsonify({
             'success': True,
             'message': 'Restart command sent to agent',
-            'project': project.to_dict()
+            'project': project
         }), 200
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error restarting project: {str(e)}")
@@ -484,10 +638,9 @@ def restart_project(project_id):
 def get_project_status(project_id):
     """Get real-time project status"""
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
+        project = _owned_project(
+            project_id, Project.status, Project.pid, Project.port, Project.last_started
+        )
         
         # Return status info
         status_data = {
@@ -504,6 +657,8 @@ def get_project_status(project_id):
             'status': status_data
         }), 200
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error fetching status: {str(e)}")
         return jsonify({
@@ -516,29 +671,51 @@ def get_project_status(project_id):
 def get_project_logs(project_id):
     """Get logs for a project"""
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
+        _owned_project(project_id)
         
         limit = request.args.get('limit', 1000, type=int)
         
-        logs = ProjectLog.query.filter_by(
-            project_id=project_id
-        ).order_by(ProjectLog.timestamp.desc()).limit(limit).all()
-        
-        # Group by type
-        stdout_logs = [log.content for log in reversed(logs) if log.log_type == 'stdout']
-        stderr_logs = [log.content for log in reversed(logs) if log.log_type == 'stderr']
-        
-        return jsonify({
-            'success': True,
-            'logs': {
-                'stdout': stdout_logs,
-                'stderr': stderr_logs
-            }
-        }), 200
-        
+        # Logs are append-only, so row count + newest id identify the content;
+        # both come off ix_projectlog_project_ts without touching log rows
+        count, newest_id = db.session.query(
+            db.func.count(ProjectLog.id), db.func.max(ProjectLog.id)
+        ).filter(ProjectLog.project_id == project_id).one()
+        etag = f"logs-{project_id}-{limit}-{count}-{newest_id or 0}"
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Newest `limit` rows via ix_projectlog_project_ts; each stream is then
+        # read oldest first as plain content values - no ProjectLog instances
+        latest = db.session.query(
+            ProjectLog.id, ProjectLog.log_type, ProjectLog.content, ProjectLog.timestamp
+        ).filter(
+            ProjectLog.project_id == project_id
+        ).order_by(ProjectLog.timestamp.desc(), ProjectLog.id.desc()).limit(limit).subquery()
+        
+        def stream_contents(log_type):
+            return db.session.query(latest.c.content).filter(
+                latest.c.log_type == log_type
+            ).order_by(latest.c.timestamp, latest.c.id).yield_per(200)
+        
+        def generate():
+            # Same document jsonify would produce, written out row by row
+            yield b'{"success":true,"logs":{"stdout":['
+            for log_type, closing in (('stdout', b'],"stderr":['), ('stderr', b']}}')):
+                separator = b''
+                for (content,) in stream_contents(log_type):
+                    yield separator + dumps_bytes(content)
+                    separator = b','
+                yield closing
+        
+        response = Response(stream_with_context(generate()), status=200, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error fetching logs: {str(e)}")
         return jsonify({
@@ -550,12 +727,29 @@ def get_project_logs(project_id):
 # AGENT API (for client communication)
 # ============================================
 
+# Pre-encoded bodies for the tiny responses agents get on every poll
+# (also served by app.py's native heartbeat handler)
+SUCCESS_BODY = b'{"success":true}'
+INVALID_API_KEY_BODY = b'{"error":"Invalid API key"}'
+
+def _json_response(body, status):
+    """Wrap pre-encoded JSON bytes in a fresh Response (never shared between requests)"""
+    return Response(body, status=status, mimetype='application/json')
+
+def record_agent_heartbeat(agent_id, data):
+    """
+    Buffer a heartbeat with the system_info from its JSON body (if any);
+    written to the agents table by the periodic flush
+    """
+    system_info = data.get('system_info') if isinstance(data, dict) else None
+    agent_presence.record_heartbeat(agent_id, system_info)
+
 def verify_agent_api_key():
-    """Verify agent API key from header"""
+    """Verify agent API key from header; returns an AgentRef (just the ID) or None"""
     api_key = request.headers.get('X-Agent-API-Key')
     if not api_key:
         return None
-    return Agent.query.filter_by(api_key=api_key).first()
+    return resolve_agent_api_key(api_key)
 
 @projects_bp.route('/api/agent/heartbeat', methods=['POST'])
 def agent_heartbeat():
@@ -563,22 +757,13 @@ def agent_heartbeat():
     try:
         agent = verify_agent_api_key()
         if not agent:
-            return jsonify({'error': 'Invalid API key'}), 401
-        
-        agent.last_heartbeat = datetime.utcnow()
-        agent.status = 'online'
-        
-        # Update system info if provided
-        data = request.get_json()
-        if data and 'system_info' in data:
-            agent.system_info = data['system_info']
+            return _json_response(INVALID_API_KEY_BODY, 401)
         
-        db.session.commit()
+        record_agent_heartbeat(agent.id, request.get_json(silent=True))
         
-        return jsonify({'success': True}), 200
+        return _json_response(SUCCESS_BODY, 200)
         
     except Exception as e:
-        db.session.rollback()
         logger.error(f"Heartbeat error: {str(e)}")
         return jsonify({'error': 'Heartbeat failed'}), 500
 
@@ -588,16 +773,28 @@ def get_agent_commands():
     try:
         agent = verify_agent_api_key()
         if not agent:
-            return jsonify({'error': 'Invalid API key'}), 401
-        
-        commands = Command.query.filter_by(
-            agent_id=agent.id,
-            status='pending'
-        ).all()
+            return _json_response(INVALID_API_KEY_BODY, 401)
+        
+        # Same payload as Command.to_dict(), built from one joined projection
+        rows = db.session.execute(_PENDING_COMMANDS, {'agent_id': agent.id})
+        
+        commands = []
+        for row in rows:
+            project = row._asdict()
+            command = {
+                'id': project.pop('command_id'),
+                'project_id': project['id'],
+                'action': project.pop('action'),
+                'status': project.pop('command_status'),
+                'result': project.pop('result'),
+                'created_at': project.pop('command_created_at')
+            }
+            command['project'] = _project_row_dict(project)
+            commands.append(command)
         
         return jsonify({
             'success': True,
-            'commands': [cmd.to_dict() for cmd in commands]
+            'commands': commands
         }), 200
         
     except Exception as e:
@@ -610,7 +807,7 @@ def complete_command(command_id):
     try:
         agent = verify_agent_api_key()
         if not agent:
-            return jsonify({'error': 'Invalid API key'}), 401
+            return _json_response(INVALID_API_KEY_BODY, 401)
         
         command = Command.query.filter_by(
             id=command_id,
@@ -648,7 +845,7 @@ def complete_command(command_id):
         
         db.session.commit()
         
-        return jsonify({'success': True}), 200
+        return _json_response(SUCCESS_BODY, 200)
         
     except Exception as e:
         db.session.rollback()
@@ -661,7 +858,7 @@ def push_logs():
     try:
         agent = verify_agent_api_key()
         if not agent:
-            return jsonify({'error': 'Invalid API key'}), 401
+            return _json_response(INVALID_API_KEY_BODY, 401)
         
         data = request.get_json()
         
@@ -669,24 +866,26 @@ def push_logs():
             return jsonify({'error': 'Invalid data'}), 400
         
         # Verify project belongs to agent
-        project = Project.query.filter_by(
+        owned = Project.query.filter_by(
             id=data['project_id'],
             agent_id=agent.id
-        ).first()
+        ).exists()
         
-        if not project:
+        if not db.session.query(owned).scalar():
             return jsonify({'error': 'Invalid project'}), 400
         
-        log = ProjectLog(
-            project_id=data['project_id'],
-            log_type=data.get('type', 'stdout'),
-            content=data['content']
-        )
-        
-        db.session.add(log)
-        db.session.commit()
+        # Buffered; inserted in batches by the periodic flush, or right
+        # here once enough lines have piled up
+        if log_buffer.add(data['project_id'], data.get('type', 'stdout'), data['content']):
+            try:
+                with db.engine.begin() as connection:
+                    log_buffer.flush(connection)
+            except Exception as e:
+                # The lines are queued (flush requeues them) and the periodic
+                # task retries; failing here would make the agent resend them
+                logger.warning(f"Inline log flush failed, left to the periodic flush: {e}")
         
-        return jsonify({'success': True}), 200
+        return _json_response(SUCCESS_BODY, 200)
         
     except Exception as e:
         db.session.rollback()
@@ -699,6 +898,7 @@ def push_logs():
 @login_required
 def toggle_project_public(project_id):
     """Toggle project public/private status"""
+    allocated_port = None
     try:
         data = request.get_json()
         
@@ -724,32 +924,50 @@ def toggle_project_public(project_id):
         
         # If making public
         if is_public and not project.is_public:
-            # Generate subdomain if not exists
+            # Generate subdomain if not exists; the unique index on
+            # subdomain decides collisions at commit time
+            base_subdomain = None
             if not project.subdomain:
-                subdomain = f"{project.name.lower()}-{current_user.username.lower()}"
-                subdomain = subdomain.replace(' ', '-').replace('_', '-')
-                
-                # Check if subdomain already exists
-                existing = Project.query.filter_by(subdomain=subdomain).first()
-                if existing and existing.id != project.id:
-                    # Add random suffix
-                    import random
-                    subdomain = f"{subdomain}-{random.randint(1000, 9999)}"
-                
-                project.subdomain = subdomain
+                base_subdomain = f"{project.name.lower()}-{current_user.username.lower()}"
+                base_subdomain = base_subdomain.replace(' ', '-').replace('_', '-')
             
             # Assign tunnel port if not exists
-            if not project.tunnel_port:
-                project.tunnel_port = find_available_tunnel_port()
+            needs_port = not project.tunnel_port
             
-            project.is_public = True
+            attempt = 0
+            for _ in range(SUBDOMAIN_ATTEMPTS + TUNNEL_PORT_ATTEMPTS):
+                if base_subdomain:
+                    # Add random suffix after a collision
+                    project.subdomain = base_subdomain if attempt == 0 else \
+                        f"{base_subdomain}-{random.randint(1000, 9999)}"
+                if needs_port:
+                    if allocated_port is None:
+                        allocated_port = find_available_tunnel_port()
+                    project.tunnel_port = allocated_port
+                project.is_public = True
+                try:
+                    db.session.commit()
+                    allocated_port = None  # assigned; nothing to release
+                    break
+                except IntegrityError as e:
+                    db.session.rollback()
+                    if needs_port and _is_tunnel_port_conflict(e):
+                        # Taken elsewhere; it stays reserved here, try another
+                        allocated_port = None
+                        continue
+                    if not base_subdomain:
+                        raise
+                    attempt += 1
+                    if attempt >= SUBDOMAIN_ATTEMPTS:
+                        raise Exception("Could not find a free subdomain")
+            else:
+                raise Exception("Could not reserve a tunnel port")
             
         # If making private
         elif not is_public and project.is_public:
             project.is_public = False
             # Keep subdomain and tunnel_port for potential re-enabling
-        
-        db.session.commit()
+            db.session.commit()
         
         logger.info(f"Project {project.name} set to {'public' if is_public else 'private'}")
         
@@ -775,6 +993,10 @@ def toggle_project_public(project_id):
             'success': False,
             'message': str(e)
         }), 500
+    finally:
+        # Reserved but never committed (any failure, not just the handled ones)
+        if allocated_port is not None:
+            tunnel_ports.release(allocated_port)
 
 
 @projects_bp.route('/api/projects/<int:project_id>/make-public', methods=['POST'])
@@ -790,17 +1012,34 @@ def make_project_public(project_id):
     subdomain = f"{project.name.lower()}-{current_user.username.lower()}"
     subdomain = subdomain.replace(' ', '-').replace('_', '-')
     
-    # Check if subdomain already exists
-    if Project.query.filter_by(subdomain=subdomain).first():
-        return jsonify({'success': False, 'message': 'Subdomain already taken'}), 400
-    
-    # Assign a tunnel port (find next available port)
-    tunnel_port = find_available_tunnel_port()
-    
-    project.is_public = True
-    project.subdomain = subdomain
-    project.tunnel_port = tunnel_port
-    db.session.commit()
+    # Assign a tunnel port (find next available port); the unique index on
+    # tunnel_port has the final say, so retry with another on a conflict
+    reserved = None
+    try:
+        for _ in range(TUNNEL_PORT_ATTEMPTS):
+            tunnel_port = reserved = find_available_tunnel_port()
+            project.is_public = True
+            project.subdomain = subdomain
+            project.tunnel_port = tunnel_port
+            try:
+                db.session.commit()
+                reserved = None  # assigned; nothing to release
+                break
+            except IntegrityError as e:
+                db.session.rollback()
+                if not _is_tunnel_port_conflict(e):
+                    # The unique index on subdomain caught a collision
+                    return jsonify({'success': False, 'message': 'Subdomain already taken'}), 400
+                # Taken elsewhere; it stays reserved here, try another
+                reserved = None
+        else:
+            raise Exception("Could not reserve a tunnel port")
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if reserved is not None:
+            tunnel_ports.release(reserved)
     
     return jsonify({
         'success': True,
@@ -818,7 +1057,8 @@ def make_project_public(project_id):
 def debug_project(project_id):
     """Debug endpoint to check project status"""
     try:
-        project = Project.query.filter_by(
+        # Agent comes in the same SELECT; any other relationship access raises
+        project = Project.query.options(joinedload(Project.agent), raiseload('*')).filter_by(
             id=project_id,
             user_id=current_user.id
         ).first_or_404()
@@ -840,14 +1080,17 @@ def debug_project(project_id):
         agent_info = None
         if project.agent:
             seconds_since_heartbeat = None
-            if project.agent.last_heartbeat:
+            if project.agent.last_heartbeat_ts:
+                seconds_since_heartbeat = int(time.time()) - project.agent.last_heartbeat_ts
+            elif project.agent.last_heartbeat:
                 seconds_since_heartbeat = (datetime.utcnow() - project.agent.last_heartbeat).total_seconds()
             
             agent_info = {
                 'id': project.agent.id,
                 'name': project.agent.name,
-                'status': project.agent.status,
+                'status': project.agent.current_status,
                 'last_heartbeat': project.agent.last_heartbeat.isoformat() if project.agent.last_heartbeat else None,
+                'last_heartbeat_ts': project.agent.last_heartbeat_ts,
                 'seconds_since_heartbeat': seconds_since_heartbeat,
             }
         
@@ -855,7 +1098,7 @@ def debug_project(project_id):
         
         # Determine if project can be accessed
         has_agent = project.agent is not None
-        agent_online = project.agent.status == 'online' if project.agent else False
+        agent_online = project.agent.current_status == 'online' if project.agent else False
         is_running = project.status == 'running'
         tunnel_active = project.id in active_tunnels
         
@@ -898,10 +1141,7 @@ def debug_register_tunnel(project_id):
     from tunnels_with_firewall import register_tunnel as reg_tunnel
     
     try:
-        project = Project.query.filter_by(
-            id=project_id,
-            user_id=current_user.id
-        ).first_or_404()
+        project = _owned_project(project_id, Project.agent_id)
         
         data = request.json or {}
         local_port = data.get('local_port', 3000)  # Default to 3000
@@ -915,6 +1155,8 @@ def debug_register_tunnel(project_id):
             'message': 'Tunnel registered successfully' if success else 'Failed to register tunnel'
         }), 200 if success else 500
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in debug_register_tunnel: {str(e)}")
         return jsonify({
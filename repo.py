@@ -1,11 +1,19 @@
-from flask import Blueprint, jsonify, request, current_app, send_file, abort
+from flask import Blueprint, jsonify, request, current_app, send_file, abort, make_response
 from flask_login import login_required, current_user
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from models import db, Repo, RepoFile, RepoStar, RepoFork, User
+from sqlalchemy import case, delete, exists, insert, literal, select, update
+from sqlalchemy.orm import selectinload
 import os
 import shutil
+import stat
+import secrets
 import mimetypes
-from datetime import datetime
+from urllib.parse import quote
+from functools import lru_cache
+from collections import OrderedDict
+import threading
 import logging
 
 # Setup logging
@@ -20,30 +28,162 @@ logger.setLevel(logging.INFO)
 repo_bp = Blueprint('repo', __name__, url_prefix='/r')
 
 # Constants for file handling
-ALLOWED_FILE_EXTENSIONS = {
+ALLOWED_FILE_EXTENSIONS = frozenset({
     'txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'yml', 'yaml',
     'jpg', 'jpeg', 'png', 'gif', 'svg', 'pdf', 'zip', 'tar', 'gz'
-}
+})
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB per file
 
 def allowed_file(filename):
     """Check if file extension is allowed for repository uploads"""
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_FILE_EXTENSIONS
+           filename.rpartition('.')[2].lower() in ALLOWED_FILE_EXTENSIONS
 
-def get_repo_path(repo):
-    """Get the file system path for a repository"""
-    repo_dir = os.path.join(current_app.config.get('REPO_STORAGE_PATH', 'repos'), 
-                           str(repo.owner_id), repo.name)
-    os.makedirs(repo_dir, exist_ok=True)
+@lru_cache(maxsize=2048)
+def _mime_for_suffix(suffix):
+    return mimetypes.guess_type('x.' + suffix)[0] or 'application/octet-stream'
+
+def _guess_mime(filename):
+    """
+    MIME type for a filename, cached on its last two extensions (enough
+    for mimetypes' compound suffixes such as .tar.gz)
+    """
+    parts = os.path.basename(filename).lower().split('.')[1:]
+    if not parts:
+        return 'application/octet-stream'
+    return _mime_for_suffix('.'.join(parts[-2:]))
+
+@lru_cache(maxsize=4096)
+def _repo_dir(base, owner_id, name):
+    """Absolute directory for a repository (pure path work, cached)"""
+    return os.path.abspath(os.path.join(base, str(owner_id), name))
+
+def get_repo_path(repo, create=False):
+    """Get the file system path for a repository, creating it only if asked"""
+    repo_dir = _repo_dir(current_app.config.get('REPO_STORAGE_PATH', 'repos'), repo.owner_id, repo.name)
+    if create:
+        os.makedirs(repo_dir, exist_ok=True)
     return repo_dir
 
-def serialize_repo(repo, user=None):
-    """Serialize repository object for API response"""
-    return {
+def _send_repo_file(repo, file_path, full_file_path, mimetype=None, download_name=None):
+    """
+    Send a file from a repository. With USE_X_ACCEL set, hand the transfer
+    to nginx via X-Accel-Redirect (an internal location mapping
+    /_protected_repos/ onto REPO_STORAGE_PATH); otherwise let send_file
+    stream it, which WSGI servers back with sendfile() where they can.
+    """
+    if not current_app.config.get('USE_X_ACCEL', False):
+        if download_name:
+            return send_file(full_file_path, as_attachment=True, download_name=download_name, conditional=True)
+        return send_file(full_file_path, mimetype=mimetype, conditional=True)
+
+    resp = make_response('')
+    resp.headers['X-Accel-Redirect'] = quote(f'/_protected_repos/{repo.owner_id}/{repo.name}/{file_path}')
+    resp.headers['Content-Type'] = mimetype or 'application/octet-stream'
+    if download_name:
+        resp.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return resp
+
+def _save_upload(file, dest, limit=MAX_FILE_SIZE, chunk_size=64 * 1024):
+    """
+    Stream an uploaded file to dest in chunks, counting bytes as they are
+    written. Returns the size, or None if the upload exceeds limit.
+
+    The data goes to a temporary file that is renamed over dest, so an
+    existing file is replaced rather than rewritten in place (forks share
+    file inodes with their original, see _fast_clone).
+    """
+    tmp_path = f"{dest}.{secrets.token_hex(4)}.part"
+    size = 0
+    try:
+        with open(tmp_path, 'xb') as out:
+            while True:
+                chunk = file.stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    break
+                out.write(chunk)
+        if size > limit:
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+def _clone_file(src, dst):
+    """Hardlink src to dst; fall back to an in-kernel copy, then a plain one"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass  # cross-device, unsupported filesystem, link limit, ...
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+def _fast_clone(src, dst):
+    """
+    Recreate the tree at src under dst, sharing file data where possible.
+    Repository files are never modified in place (uploads replace them via
+    rename), so hardlinked copies stay independent.
+    """
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                _fast_clone(entry.path, target)
+            elif entry.is_file():
+                _clone_file(entry.path, target)
+
+def _safe_join(base_abs, rel):
+    """
+    Join rel onto an absolute base directory, or return None if the result
+    would land outside it. base_abs must already be absolute and normalized.
+    """
+    candidate = os.path.normpath(os.path.join(base_abs, rel)) if rel else base_abs
+    if candidate != base_abs and not candidate.startswith(base_abs + os.sep):
+        return None
+    return candidate
+
+# Serialized repo-only fields, keyed by (repo ID, updated_at). Every ORM
+# UPDATE of a repo bumps updated_at (onupdate), so a changed repo simply
+# misses the cache; stale entries age out of the LRU.
+# Structure: OrderedDict{(repo_id, updated_at): dict}
+_repo_base_cache = OrderedDict()
+_repo_base_lock = threading.Lock()
+REPO_BASE_CACHE_SIZE = 4096
+
+def _serialize_repo_base(repo):
+    """Viewer- and owner-independent part of serialize_repo, cached"""
+    key = (repo.id, repo.updated_at)
+    with _repo_base_lock:
+        base = _repo_base_cache.get(key)
+        if base is not None:
+            _repo_base_cache.move_to_end(key)
+            return base
+
+    base = {
         'id': repo.id,
         'name': repo.name,
-        'full_name': repo.full_name,
         'description': repo.description,
         'is_private': repo.is_private,
         'language': repo.language,
@@ -52,16 +192,62 @@ def serialize_repo(repo, user=None):
         'issues_count': repo.issues_count,
         'commits_count': repo.commits_count,
         'size': repo.size,
-        'created_at': repo.created_at.isoformat(),
-        'updated_at': repo.updated_at.isoformat(),
+        'created_at': repo.created_at,
+        'updated_at': repo.updated_at
+    }
+    with _repo_base_lock:
+        _repo_base_cache[key] = base
+        if len(_repo_base_cache) > REPO_BASE_CACHE_SIZE:
+            _repo_base_cache.popitem(last=False)
+    return base
+
+def serialize_repo(repo, user=None, starred_ids=None, forked_ids=None):
+    """
+    Serialize repository object for API response
+
+    starred_ids/forked_ids: optional sets of repo IDs the user has starred
+    or forked, prefetched by list endpoints to avoid two queries per repo
+    """
+    if starred_ids is not None:
+        is_starred = repo.id in starred_ids
+    else:
+        is_starred = repo.is_starred_by(user) if user else False
+    if forked_ids is not None:
+        is_forked = repo.id in forked_ids
+    else:
+        is_forked = repo.is_forked_by(user) if user else False
+
+    # Owner fields can change without touching the repo row, so they are
+    # read fresh (the owner is already loaded)
+    owner = repo.owner
+    return {
+        **_serialize_repo_base(repo),
+        'full_name': f"{owner.username}/{repo.name}",
         'owner': {
-            'username': repo.owner.username,
-            'avatar_url': repo.owner.avatar_url() if callable(repo.owner.avatar_url) else repo.owner.avatar_url
+            'username': owner.username,
+            'avatar_url': owner.avatar_url() if callable(owner.avatar_url) else owner.avatar_url
         },
-        'is_starred': repo.is_starred_by(user) if user else False,
-        'is_forked': repo.is_forked_by(user) if user else False
+        'is_starred': is_starred,
+        'is_forked': is_forked
     }
 
+def _bump_repo_counters(repo_id, **values):
+    """
+    Apply SQL-side counter updates (e.g. stars_count=Repo.stars_count + 1)
+    to one repo in a single atomic UPDATE
+    """
+    db.session.execute(
+        update(Repo).where(Repo.id == repo_id).values(**values),
+        execution_options={'synchronize_session': False}
+    )
+
+def _row_exists(*criteria):
+    """SELECT EXISTS(...) for the given criteria, without loading a row"""
+    return db.session.execute(select(exists().where(*criteria))).scalar()
+
+def _repo_stars_count(repo_id):
+    return db.session.execute(select(Repo.stars_count).where(Repo.id == repo_id)).scalar()
+
 # Repository Management Endpoints
 
 @repo_bp.route('/api/repos', methods=['GET'])
@@ -69,16 +255,28 @@ def serialize_repo(repo, user=None):
 def get_repositories():
     """Fetch all repositories for the current user"""
     try:
-        # Get user's own repositories and public repositories they have access to
+        # Get user's own repositories and public repositories they have access to.
+        # Own repos need no owner eager load: current_user is already in the session
         user_repos = Repo.query.filter_by(owner_id=current_user.id).all()
-        public_repos = Repo.query.filter(
+        public_repos = Repo.query.options(selectinload(Repo.owner)).filter(
             Repo.is_private == False,
             Repo.owner_id != current_user.id
         ).limit(50).all()  # Limit public repos for performance
         
         all_repos = user_repos + public_repos
         
-        repos_data = [serialize_repo(repo, current_user) for repo in all_repos]
+        # Star/fork state for every listed repo in two queries, not two per repo
+        repo_ids = [repo.id for repo in all_repos]
+        starred_ids, forked_ids = set(), set()
+        if repo_ids:
+            starred_ids = set(db.session.scalars(
+                select(RepoStar.repo_id).where(RepoStar.user_id == current_user.id, RepoStar.repo_id.in_(repo_ids))
+            ))
+            forked_ids = set(db.session.scalars(
+                select(RepoFork.repo_id).where(RepoFork.user_id == current_user.id, RepoFork.repo_id.in_(repo_ids))
+            ))
+        
+        repos_data = [serialize_repo(repo, current_user, starred_ids, forked_ids) for repo in all_repos]
         
         return jsonify({
             'repos': repos_data,
@@ -125,7 +323,7 @@ def create_repository():
         db.session.commit()
         
         # Create repository directory
-        repo_path = get_repo_path(repo)
+        repo_path = get_repo_path(repo, create=True)
         
         # Create initial README if description provided
         if description:
@@ -173,36 +371,45 @@ def get_repo_files(repo_id):
         
         path = request.args.get('path', '').strip('/')
         repo_path = get_repo_path(repo)
-        full_path = os.path.join(repo_path, path) if path else repo_path
         
         # Security check - ensure path is within repo directory
-        if not os.path.abspath(full_path).startswith(os.path.abspath(repo_path)):
+        full_path = _safe_join(repo_path, path)
+        if full_path is None:
             return jsonify({'error': 'Invalid path'}), 400
         
         entries = []
         
-        if os.path.exists(full_path) and os.path.isdir(full_path):
-            for item in sorted(os.listdir(full_path)):
-                if item.startswith('.'):  # Skip hidden files
-                    continue
+        # One getdents pass; DirEntry caches the file type, so only files
+        # cost an extra stat (for their size)
+        prefix = f"{path}/" if path else ''
+        try:
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name.startswith('.'):  # Skip hidden files
+                        continue
                     
-                item_path = os.path.join(full_path, item)
-                relative_path = os.path.join(path, item) if path else item
-                
-                if os.path.isdir(item_path):
-                    entries.append({
-                        'type': 'dir',
-                        'name': item,
-                        'path': relative_path.replace('\\', '/')
-                    })
-                else:
-                    file_size = os.path.getsize(item_path)
-                    entries.append({
-                        'type': 'file',
-                        'name': item,
-                        'path': relative_path.replace('\\', '/'),
-                        'size': file_size
-                    })
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries.append({
+                                'type': 'dir',
+                                'name': name,
+                                'path': prefix + name
+                            })
+                        else:
+                            entries.append({
+                                'type': 'file',
+                                'name': name,
+                                'path': prefix + name,
+                                'size': entry.stat(follow_symlinks=False).st_size
+                            })
+                    except OSError:
+                        # Removed between listing and stat
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        
+        entries.sort(key=lambda e: e['name'])
         
         return jsonify({
             'entries': entries,
@@ -230,16 +437,17 @@ def upload_files(repo_id):
         if not files or all(f.filename == '' for f in files):
             return jsonify({'error': 'No files selected'}), 400
         
-        repo_path = get_repo_path(repo)
-        target_dir = os.path.join(repo_path, upload_path) if upload_path else repo_path
+        repo_path = get_repo_path(repo, create=True)
         
         # Security check
-        if not os.path.abspath(target_dir).startswith(os.path.abspath(repo_path)):
+        target_dir = _safe_join(repo_path, upload_path)
+        if target_dir is None:
             return jsonify({'error': 'Invalid upload path'}), 400
         
         os.makedirs(target_dir, exist_ok=True)
         
         uploaded_files = []
+        file_rows = []
         total_size = 0
         
         for file in files:
@@ -257,35 +465,36 @@ def upload_files(repo_id):
             file_path = os.path.join(target_dir, filename)
             relative_path = os.path.join(upload_path, filename) if upload_path else filename
             
-            # Check file size before saving [[2]](#__2)
-            file.seek(0, 2)  # Seek to end
-            file_size = file.tell()
-            file.seek(0)  # Reset to beginning
-            
-            if file_size > MAX_FILE_SIZE:
+            # Reject by the part's declared length when the client sent one
+            if file.content_length and file.content_length > MAX_FILE_SIZE:
                 return jsonify({'error': f'File too large: {filename}'}), 400
             
-            # Save file
-            file.save(file_path)
-            
-            # Add to database
-            mime_type, _ = mimetypes.guess_type(filename)
-            repo_file = RepoFile(
-                repo_id=repo.id,
-                path=relative_path.replace('\\', '/'),
-                filename=filename,
-                size=file_size,
-                content_type=mime_type or 'application/octet-stream'
-            )
+            # Save file, measuring it on the way to disk
+            file_size = _save_upload(file, file_path)
+            if file_size is None:
+                return jsonify({'error': f'File too large: {filename}'}), 400
             
-            db.session.add(repo_file)
+            # Queue the database row; all of them are inserted together below
+            mime_type = _guess_mime(filename)
+            file_rows.append({
+                'repo_id': repo.id,
+                'path': relative_path.replace('\\', '/'),
+                'filename': filename,
+                'size': file_size,
+                'content_type': mime_type
+            })
             uploaded_files.append(filename)
             total_size += file_size
         
-        # Update repository stats
-        repo.updated_at = datetime.utcnow()
-        repo.size += total_size // 1024  # Convert to KB
-        repo.commits_count += 1
+        if file_rows:
+            db.session.execute(insert(RepoFile), file_rows)
+        
+        # Update repository stats (updated_at is set by the column's onupdate)
+        _bump_repo_counters(
+            repo.id,
+            size=Repo.size + total_size // 1024,  # Convert to KB
+            commits_count=Repo.commits_count + 1
+        )
         
         db.session.commit()
         
@@ -309,26 +518,29 @@ def upload_files(repo_id):
 def star_repository(repo_id):
     """Star a repository"""
     try:
-        repo = Repo.query.get_or_404(repo_id)
+        if not _row_exists(Repo.id == repo_id):
+            abort(404)
         
         # Check if already starred
-        existing_star = RepoStar.query.filter_by(repo_id=repo_id, user_id=current_user.id).first()
-        if existing_star:
+        if _row_exists(RepoStar.repo_id == repo_id, RepoStar.user_id == current_user.id):
             return jsonify({'error': 'Repository already starred'}), 400
         
         # Create star
         star = RepoStar(repo_id=repo_id, user_id=current_user.id)
         db.session.add(star)
         
-        # Update count
-        repo.stars_count += 1
+        # Update count in SQL so concurrent stars can't lose increments
+        _bump_repo_counters(repo_id, stars_count=Repo.stars_count + 1)
+        stars_count = _repo_stars_count(repo_id)
         db.session.commit()
         
         return jsonify({
             'starred': True,
-            'stars_count': repo.stars_count
+            'stars_count': stars_count
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error starring repository: {str(e)}")
@@ -339,24 +551,31 @@ def star_repository(repo_id):
 def unstar_repository(repo_id):
     """Unstar a repository"""
     try:
-        repo = Repo.query.get_or_404(repo_id)
+        if not _row_exists(Repo.id == repo_id):
+            abort(404)
         
-        # Find and remove star
-        star = RepoStar.query.filter_by(repo_id=repo_id, user_id=current_user.id).first()
-        if not star:
+        # Remove star with one DELETE; its rowcount says whether there was one
+        deleted = db.session.execute(
+            delete(RepoStar).where(RepoStar.repo_id == repo_id, RepoStar.user_id == current_user.id),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        if not deleted:
             return jsonify({'error': 'Repository not starred'}), 400
         
-        db.session.delete(star)
-        
-        # Update count
-        repo.stars_count = max(0, repo.stars_count - 1)
+        # Update count in SQL so concurrent unstars can't lose decrements
+        _bump_repo_counters(
+            repo_id, stars_count=case((Repo.stars_count > 0, Repo.stars_count - 1), else_=0)
+        )
+        stars_count = _repo_stars_count(repo_id)
         db.session.commit()
         
         return jsonify({
             'starred': False,
-            'stars_count': repo.stars_count
+            'stars_count': stars_count
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         logger.error(f"Error unstarring repository: {str(e)}")
@@ -377,8 +596,7 @@ def fork_repository(repo_id):
             return jsonify({'error': 'Cannot fork private repository'}), 403
         
         # Check if already forked
-        existing_fork = RepoFork.query.filter_by(repo_id=repo_id, user_id=current_user.id).first()
-        if existing_fork:
+        if _row_exists(RepoFork.repo_id == repo_id, RepoFork.user_id == current_user.id):
             return jsonify({'error': 'Repository already forked'}), 400
         
         # Create forked repository
@@ -401,22 +619,21 @@ def fork_repository(repo_id):
         
         # Copy files
         original_path = get_repo_path(original_repo)
-        fork_path = get_repo_path(forked_repo)
+        fork_path = get_repo_path(forked_repo, create=True)
         
         if os.path.exists(original_path):
-            shutil.copytree(original_path, fork_path, dirs_exist_ok=True)
+            _fast_clone(original_path, fork_path)
             
-            # Copy file records
-            original_files = RepoFile.query.filter_by(repo_id=original_repo.id).all()
-            for file_record in original_files:
-                fork_file = RepoFile(
-                    repo_id=forked_repo.id,
-                    path=file_record.path,
-                    filename=file_record.filename,
-                    size=file_record.size,
-                    content_type=file_record.content_type
+            # Copy file records with one INSERT ... SELECT, no rows through Python
+            db.session.execute(
+                insert(RepoFile).from_select(
+                    ['repo_id', 'path', 'filename', 'size', 'content_type'],
+                    select(
+                        literal(forked_repo.id), RepoFile.path, RepoFile.filename,
+                        RepoFile.size, RepoFile.content_type
+                    ).where(RepoFile.repo_id == original_repo.id)
                 )
-                db.session.add(fork_file)
+            )
         
         # Create fork relationship
         fork_relation = RepoFork(
@@ -427,7 +644,7 @@ def fork_repository(repo_id):
         db.session.add(fork_relation)
         
         # Update original repo fork count
-        original_repo.forks_count += 1
+        _bump_repo_counters(original_repo.id, forks_count=Repo.forks_count + 1)
         
         db.session.commit()
         
@@ -462,19 +679,24 @@ def serve_raw_file(username, repo_name, file_path):
             abort(403)
         
         repo_path = get_repo_path(repo)
-        full_file_path = os.path.join(repo_path, file_path)
         
         # Security check
-        if not os.path.abspath(full_file_path).startswith(os.path.abspath(repo_path)):
+        full_file_path = _safe_join(repo_path, file_path)
+        if full_file_path is None:
             abort(400)
         
-        if not os.path.exists(full_file_path) or os.path.isdir(full_file_path):
+        # One stat answers both "does it exist" and "is it a regular file"
+        try:
+            st = os.stat(full_file_path)
+        except OSError:
+            abort(404)
+        if not stat.S_ISREG(st.st_mode):
             abort(404)
         
         # Determine MIME type
-        mime_type, _ = mimetypes.guess_type(full_file_path)
+        mime_type = _guess_mime(file_path)
         
-        return send_file(full_file_path, mimetype=mime_type)
+        return _send_repo_file(repo, file_path, full_file_path, mimetype=mime_type)
         
     except Exception as e:
         logger.error(f"Error serving raw file: {str(e)}")
@@ -493,17 +715,22 @@ def download_file(username, repo_name, file_path):
             abort(403)
         
         repo_path = get_repo_path(repo)
-        full_file_path = os.path.join(repo_path, file_path)
         
         # Security check
-        if not os.path.abspath(full_file_path).startswith(os.path.abspath(repo_path)):
+        full_file_path = _safe_join(repo_path, file_path)
+        if full_file_path is None:
             abort(400)
         
-        if not os.path.exists(full_file_path) or os.path.isdir(full_file_path):
+        # One stat answers both "does it exist" and "is it a regular file"
+        try:
+            st = os.stat(full_file_path)
+        except OSError:
+            abort(404)
+        if not stat.S_ISREG(st.st_mode):
             abort(404)
         
         filename = os.path.basename(file_path)
-        return send_file(full_file_path, as_attachment=True, download_name=filename)
+        return _send_repo_file(repo, file_path, full_file_path, download_name=filename)
         
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
@@ -1,6 +1,17 @@
 from functools import wraps
 from flask import make_response, request
 
+# CSP headers stripped from every response (lowercase, for matching)
+_CSP_HEADERS = frozenset({
+    'content-security-policy',
+    'content-security-policy-report-only',
+    'x-content-security-policy',
+    'x-webkit-csp'
+})
+
+# Permissive CSP header added to every response
+_PERMISSIVE_CSP = "default-src * 'unsafe-inline' 'unsafe-eval'; script-src * 'unsafe-inline' 'unsafe-eval'; connect-src * 'unsafe-inline'; img-src * data: blob: 'unsafe-inline'; frame-src *; style-src * 'unsafe-inline';"
+
 def disable_csp(app):
     """
     Middleware to disable Content Security Policy headers
@@ -8,21 +19,17 @@ def disable_csp(app):
     """
     @app.after_request
     def add_security_headers(response):
-        # Remove any existing CSP headers
-        headers_to_remove = [
-            'Content-Security-Policy',
-            'Content-Security-Policy-Report-Only',
-            'X-Content-Security-Policy',
-            'X-WebKit-CSP'
-        ]
-        
-        for header in headers_to_remove:
-            if header in response.headers:
-                del response.headers[header]
-        
-        # Add permissive CSP header
-        response.headers['Content-Security-Policy'] = "default-src * 'unsafe-inline' 'unsafe-eval'; script-src * 'unsafe-inline' 'unsafe-eval'; connect-src * 'unsafe-inline'; img-src * data: blob: 'unsafe-inline'; frame-src *; style-src * 'unsafe-inline';"
-        
+        headers = response.headers
+
+        # Remove any existing CSP headers in one pass over the header list
+        kept = [(key, value) for key, value in headers if key.lower() not in _CSP_HEADERS]
+        if len(kept) != len(headers):
+            headers.clear()
+            headers.extend(kept)
+
+        # Add permissive CSP header (none is left, so a plain append will do)
+        headers.add('Content-Security-Policy', _PERMISSIVE_CSP)
+
         return response
-    
-    return app
\ No newline at end of file
+
+    return app
@@ -229,13 +229,13 @@ const FirewallView = ({ showToast }: FirewallViewProps) => {
       const data = JSON.parse(importData);
       
       // Send to API
-      const response = await axios.post<{ rules: Rule[] }>(
+      await axios.post<{ created_ids: number[]; created_count: number }>(
         `/api/projects/${selectedProject.id}/firewall/import`, 
         data
       );
       
-      // Update rules list
-      setRules(response.data.rules || []);
+      // Reload rules list
+      await fetchRules(selectedProject.id);
       
       // Reset form and close modal
       setImportData('');
@@ -6,6 +6,17 @@ from typing import Optional
 
 log = logging.getLogger(__name__)
 
+# Compiled once; these run for every subdomain request
+_VALID = re.compile(r'[a-z0-9-]+')
+_INVALID_CHARS = re.compile(r'[^a-z0-9-]')
+_DASHES = re.compile(r'-+')
+
+# normalize_subdomain works on ASCII bytes: space becomes '-', everything
+# outside [a-z0-9-] is deleted, all in one C-level bytes.translate pass
+_ALLOWED_BYTES = b'abcdefghijklmnopqrstuvwxyz0123456789-'
+_SPACE_TO_DASH = bytes.maketrans(b' ', b'-')
+_DISALLOWED_BYTES = bytes(b for b in range(256) if b not in _ALLOWED_BYTES and b != ord(' '))
+
 def extract_subdomain(host: str, domain: str) -> Optional[str]:
     """
     Extract subdomain from host header
@@ -15,11 +26,13 @@ def extract_subdomain(host: str, domain: str) -> Optional[str]:
         - None if accessing root domain
         - "__invalid__" if invalid domain
     """
-    host_without_port = (host or "").lower().split(":")[0]
-    if host_without_port.endswith(f".{domain}"):
-        return host_without_port[:-(len(domain) + 1)]
-    if host_without_port == domain:
-        return None
+    host_without_port = (host or "").lower().partition(":")[0]
+    if host_without_port.endswith(domain):
+        cut = len(host_without_port) - len(domain)
+        if cut == 0:
+            return None
+        if host_without_port[cut - 1] == ".":
+            return host_without_port[:cut - 1]
     return "__invalid__"
 
 
@@ -37,7 +50,7 @@ def validate_subdomain_name(name: str) -> bool:
         return False
     
     # Only allow alphanumeric, hyphens
-    if not re.match(r'^[a-z0-9-]+$', name):
+    if not _VALID.fullmatch(name):
         return False
     
     # Cannot start or end with hyphen
@@ -65,31 +78,34 @@ def generate_subdomain(project_name: str, username: str, db: Session, project_mo
         unique subdomain string
     """
     # Create base subdomain
-    subdomain = f"{project_name}-{username}".lower()
-    subdomain = re.sub(r'[^a-z0-9-]', '', subdomain.replace(' ', '-'))
-    subdomain = re.sub(r'-+', '-', subdomain)
-    subdomain = subdomain.strip('-')
+    subdomain = normalize_subdomain(f"{project_name}-{username}")
     
     # Ensure it's valid
     if not validate_subdomain_name(subdomain):
         subdomain = f"project-{username}".lower()
-        subdomain = re.sub(r'[^a-z0-9-]', '', subdomain)
+        subdomain = _INVALID_CHARS.sub('', subdomain)
     
-    # Check uniqueness
+    # Check uniqueness: fetch every taken variant (base, base-1, base-2, ...)
+    # in one indexed query instead of probing suffixes one SELECT at a time
     original_subdomain = subdomain
-    counter = 1
+    taken = {
+        row[0] for row in db.query(project_model.subdomain).filter(
+            (project_model.subdomain == original_subdomain) |
+            project_model.subdomain.like(f"{original_subdomain}-%")
+        )
+    }
     
-    while db.query(project_model).filter_by(subdomain=subdomain).first():
+    if original_subdomain not in taken:
+        return original_subdomain
+    
+    for counter in range(1, 1001):
         subdomain = f"{original_subdomain}-{counter}"
-        counter += 1
-        
-        # Safety limit
-        if counter > 1000:
-            import secrets
-            subdomain = f"{original_subdomain}-{secrets.token_hex(4)}"
-            break
+        if subdomain not in taken:
+            return subdomain
     
-    return subdomain
+    # Safety limit
+    import secrets
+    return f"{original_subdomain}-{secrets.token_hex(4)}"
 
 
 def normalize_subdomain(subdomain: str) -> str:
@@ -102,8 +118,9 @@ def normalize_subdomain(subdomain: str) -> str:
     Returns:
         normalized subdomain
     """
-    subdomain = subdomain.lower()
-    subdomain = re.sub(r'[^a-z0-9-]', '', subdomain.replace(' ', '-'))
-    subdomain = re.sub(r'-+', '-', subdomain)
-    subdomain = subdomain.strip('-')
-    return subdomain
+    # Non-ASCII characters are dropped by the encode, the rest by translate
+    raw = subdomain.lower().encode('ascii', 'ignore')
+    subdomain = raw.translate(_SPACE_TO_DASH, _DISALLOWED_BYTES).decode('ascii')
+    if '--' in subdomain:
+        subdomain = _DASHES.sub('-', subdomain)
+    return subdomain.strip('-')
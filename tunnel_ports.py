@@ -0,0 +1,74 @@
+# tunnel_ports.py
+import heapq
+import threading
+from typing import Callable, Iterable
+
+# Tunnel ports are handed out from [TUNNEL_PORT_MIN, TUNNEL_PORT_MAX)
+TUNNEL_PORT_MIN = 10000
+TUNNEL_PORT_MAX = 20000
+
+# Allocator state, loaded from the database on first use. It only proposes
+# ports: other workers (or manual edits) can assign ports behind its back,
+# so the unique index on projects.tunnel_port decides at commit time. A port
+# that loses there stays reserved here and the caller allocates another.
+# _used: every port currently assigned to a project
+# _free: min-heap of unassigned ports below _next
+# _next: lowest port above every port handed out so far
+_used = None
+_free = []
+_next = TUNNEL_PORT_MIN
+_lock = threading.Lock()
+
+def _load(used_ports: Iterable[int]) -> None:
+    global _used, _free, _next
+    _used = {port for port in used_ports if TUNNEL_PORT_MIN <= port < TUNNEL_PORT_MAX}
+    _next = max(_used) + 1 if _used else TUNNEL_PORT_MIN
+    _free = [port for port in range(TUNNEL_PORT_MIN, _next) if port not in _used]
+    heapq.heapify(_free)
+
+def allocate(load_used_ports: Callable[[], Iterable[int]]) -> int:
+    """
+    Reserve and return the lowest free tunnel port
+
+    Args:
+        load_used_ports: Returns the ports already assigned; called the
+            first time to seed the allocator, and again before giving up
+            in case ports were freed elsewhere
+
+    Raises:
+        Exception: If every port in the range is taken
+    """
+    with _lock:
+        if _used is None:
+            _load(load_used_ports())
+        port = _take()
+        if port is None:
+            _load(load_used_ports())
+            port = _take()
+    if port is None:
+        raise Exception("No available tunnel ports")
+    return port
+
+def _take():
+    global _next
+    while _free:
+        port = heapq.heappop(_free)
+        if port not in _used:
+            _used.add(port)
+            return port
+
+    if _next < TUNNEL_PORT_MAX:
+        port = _next
+        _next += 1
+        _used.add(port)
+        return port
+    return None
+
+def release(port: int) -> None:
+    """Return a port to the pool, e.g. after its project was deleted or a
+    commit that would have assigned it failed"""
+    with _lock:
+        if _used is None or port not in _used:
+            return
+        _used.discard(port)
+        heapq.heappush(_free, port)
@@ -3,17 +3,24 @@ import base64
 import json
 import logging
 import os
-import secrets
 import time
 from typing import Dict, Optional, Any, Callable, List, Tuple
 import datetime
+import heapq
+import itertools
+from functools import lru_cache
+from collections import OrderedDict
+import threading
 import aiohttp
 from aiohttp import web
+from multidict import CIMultiDict
+from sqlalchemy import bindparam, or_, select
 from sqlalchemy.orm import scoped_session
+from subdomain_handling import generate_subdomain, extract_subdomain
 
 # Set up logging
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
 # Configure console handler
 if not log.handlers:
@@ -24,22 +31,138 @@ if not log.handlers:
     log.addHandler(ch)
 
 # Global storage for active tunnels
-tunnels = {}  # Maps subdomain to websocket connection
-tunnel_to_project = {}  # Maps subdomain to project_id
-pending_requests = {}  # Maps request_id to {event, response}
+tunnels = {}  # Maps subdomain to Tunnel
+pending_requests = {}  # Maps request_id to (future resolved with the response, Tunnel it was sent to)
+response_streams = {}  # Maps request_id to (asyncio.Queue of body chunks, Tunnel streaming it)
+
+# Request IDs only need to be unique within this process: responses are
+# matched against the tunnel the request went to, so a counter is enough
+# (no os.urandom call per proxied request). IDs go out as plain ints, which
+# agents echo back unchanged and msgpack encodes in a few bytes
+_request_ids = itertools.count(1)
+
+# (deadline, request_id) for every request sent, ordered by deadline, so
+# cleanup_old_requests only visits entries that are actually past due
+_pending_deadlines = []
 
 # Request timeout in seconds
 REQUEST_TIMEOUT = 30.0
 
+# Proxied requests allowed in flight at once; beyond this new ones get 503
+MAX_PENDING_REQUESTS = 10000
+
+# Proxied requests allowed in flight per tunnel; others wait up to
+# TUNNEL_SLOT_WAIT seconds for a slot and then get 503
+MAX_TUNNEL_IN_FLIGHT = 64
+TUNNEL_SLOT_WAIT = 1.0
+
+# Binary tunnel responses larger than this (in base64 chars) are streamed;
+# slices must be a multiple of 4 chars to decode independently
+STREAM_BODY_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_CHARS = 256 * 1024
+
+# Chunks of a streamed tunnel response buffered for a slow client. The
+# receive loop is shared by every request on the tunnel and never waits on
+# one client; instead the agent gets this many chunks of credit per stream
+# (announced as "stream_window") and one more for each http_response_ack
+# sent once the client has taken a chunk. An agent that overruns its window
+# has the stream aborted and cancelled (the queue keeps one extra slot so
+# the end marker always fits)
+STREAM_QUEUE_SIZE = 8
+
+# Queued instead of the end marker (None) when a streamed body can't be
+# completed; the client connection is then dropped rather than ended cleanly
+STREAM_ABORTED = object()
+
+# Subdomains without an active tunnel -> (expires at, project name or None)
+_inactive_lookups = OrderedDict()
+INACTIVE_LOOKUP_TTL = 60  # seconds
+INACTIVE_LOOKUP_MAX = 2048
+
 def set_request_timeout(timeout: float):
     """Set the timeout for tunnel requests"""
     global REQUEST_TIMEOUT
     REQUEST_TIMEOUT = timeout
 
+# Project status changes not yet written to the database
+# Structure: {project_id: (status, last_started datetime or None, queued_at datetime)}
+_status_pending = {}
+_status_lock = threading.Lock()
+_project_table = None  # projects table, captured from the model passed in
+
+# How often queued status changes are written
+STATUS_FLUSH_INTERVAL = 0.5  # seconds
+
+def queue_project_status(project_model, project_id: int, status: str,
+                         last_started: Optional[datetime.datetime] = None) -> None:
+    """Queue a project status change; the latest change per project wins"""
+    global _project_table
+    _project_table = project_model.__table__
+    queued_at = datetime.datetime.utcnow()
+    with _status_lock:
+        _status_pending[project_id] = (status, last_started, queued_at)
+
+def has_pending_status() -> bool:
+    """True if there are project status changes waiting to be flushed"""
+    return bool(_status_pending)
+
+def flush_project_status(connection) -> int:
+    """
+    Write queued project status changes with executemany UPDATEs
+
+    A change is skipped when the row's updated_at is newer than the time
+    it was queued, so a status written meanwhile by the start/stop/restart
+    API is not overwritten by a stale tunnel event.
+
+    Args:
+        connection: SQLAlchemy connection inside a transaction
+
+    Returns:
+        Number of project rows written
+    """
+    with _status_lock:
+        if not _status_pending:
+            return 0
+        pending = _status_pending.copy()
+        _status_pending.clear()
+
+    projects = _project_table
+    update_by_id = projects.update().where(
+        projects.c.id == bindparam('project_id'),
+        or_(projects.c.updated_at.is_(None), projects.c.updated_at <= bindparam('queued_at'))
+    )
+    started = [{'project_id': pid, 'new_status': st, 'started': ts, 'queued_at': queued}
+               for pid, (st, ts, queued) in pending.items() if ts is not None]
+    plain = [{'project_id': pid, 'new_status': st, 'queued_at': queued}
+             for pid, (st, ts, queued) in pending.items() if ts is None]
+    written = 0
+    try:
+        if started:
+            written += connection.execute(
+                update_by_id.values(status=bindparam('new_status'), last_started=bindparam('started'),
+                                    updated_at=bindparam('queued_at')),
+                started
+            ).rowcount
+        if plain:
+            written += connection.execute(
+                update_by_id.values(status=bindparam('new_status'), updated_at=bindparam('queued_at')),
+                plain
+            ).rowcount
+    except Exception:
+        # Requeue unless a newer change arrived in the meantime
+        with _status_lock:
+            for project_id, change in pending.items():
+                _status_pending.setdefault(project_id, change)
+        raise
+    return written
+
 # Rate limiting
-rate_limits = {}  # Maps IP to {count, timestamp}
+# Token bucket per IP, packed into one int: (tokens << 32) | last refill (ms, 32 bits)
+rate_limits = {}
 RATE_LIMIT_MAX = 100  # Maximum requests per minute
 RATE_LIMIT_WINDOW = 60  # Window in seconds
+_RATE_WINDOW_MS = RATE_LIMIT_WINDOW * 1000
+_MS_MASK = 0xFFFFFFFF
 
 def check_rate_limit(ip: str) -> bool:
     """
@@ -51,40 +174,55 @@ def check_rate_limit(ip: str) -> bool:
     Returns:
         True if within rate limit, False if exceeded
     """
-    now = time.time()
-    
-    if ip not in rate_limits:
-        rate_limits[ip] = {'count': 1, 'timestamp': now}
-        return True
-        
-    # Reset counter if window has passed
-    if now - rate_limits[ip]['timestamp'] > RATE_LIMIT_WINDOW:
-        rate_limits[ip] = {'count': 1, 'timestamp': now}
+    now = time.monotonic_ns() // 1_000_000
+    state = rate_limits.get(ip)
+    if state is None:
+        rate_limits[ip] = ((RATE_LIMIT_MAX - 1) << 32) | (now & _MS_MASK)
         return True
-        
-    # Increment counter
-    rate_limits[ip]['count'] += 1
-    
-    # Check if limit exceeded
-    if rate_limits[ip]['count'] > RATE_LIMIT_MAX:
+
+    tokens = state >> 32
+    last = state & _MS_MASK
+    # Refill whole tokens only; the refill time is advanced by just the time
+    # those tokens took, so frequent checks don't lose partial refills
+    elapsed = (now - last) & _MS_MASK
+    gained = elapsed * RATE_LIMIT_MAX // _RATE_WINDOW_MS
+    if gained:
+        tokens += gained
+        if tokens >= RATE_LIMIT_MAX:
+            tokens = RATE_LIMIT_MAX
+            last = now
+        else:
+            last += gained * _RATE_WINDOW_MS // RATE_LIMIT_MAX
+
+    if tokens == 0:
+        rate_limits[ip] = last & _MS_MASK
         return False
-        
+
+    rate_limits[ip] = ((tokens - 1) << 32) | (last & _MS_MASK)
     return True
 
 def cleanup_old_requests():
-    """Remove expired requests from the pending_requests dict"""
-    now = time.time()
-    to_remove = []
+    """Remove requests left behind in pending_requests past their deadline"""
+    now = time.monotonic()
+    removed = 0
     
-    for req_id, req_data in pending_requests.items():
-        if now - req_data['timestamp'] > REQUEST_TIMEOUT:
-            to_remove.append(req_id)
-            
-    for req_id in to_remove:
-        pending_requests.pop(req_id, None)
+    # http_handler pops its own entry, so most heap entries are already gone;
+    # by its deadline anything still present has resolved, timed out
+    # (wait_for cancels the future) or been cancelled and is just a leftover
+    while _pending_deadlines and _pending_deadlines[0][0] <= now:
+        _, req_id = heapq.heappop(_pending_deadlines)
+        if pending_requests.pop(req_id, None) is not None:
+            removed += 1
         
-    if to_remove:
-        log.debug(f"Cleaned up {len(to_remove)} expired requests")
+    if removed:
+        log.debug(f"Cleaned up {removed} expired requests")
+
+    # Forget IPs idle for a whole window; their bucket would be full again
+    now_ms = time.monotonic_ns() // 1_000_000
+    expired_ips = [ip for ip, state in rate_limits.items()
+                   if (now_ms - state) & _MS_MASK >= _RATE_WINDOW_MS]
+    for ip in expired_ips:
+        rate_limits.pop(ip, None)
 
 # Schedule periodic cleanup
 async def cleanup_task():
@@ -95,14 +233,221 @@ async def cleanup_task():
 
 # Start the cleanup task
 
+# Firewall checks for proxied requests, imported once rather than per request
+try:
+    import firewall_aiohttp
+except ImportError as e:
+    firewall_aiohttp = None
+    log.error(f"Error importing firewall module: {e}")
+
 # JSON serialization/deserialization with binary support
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+    log.warning("orjson not installed; tunnel messages use the slower stdlib json")
+
 def dumps(o):
-    """Serialize object to JSON"""
+    """Serialize object to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(o)
     return json.dumps(o).encode('utf-8')
 
 def loads(b):
-    """Deserialize JSON to object"""
-    return json.loads(b.decode('utf-8'))
+    """Deserialize JSON (bytes or str) to object"""
+    if orjson is not None:
+        return orjson.loads(b)
+    return json.loads(b)
+
+# Hop-by-hop headers plus Host (the client sets its own), never forwarded
+_SKIPPED_REQUEST_HEADERS = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'host'
+})
+
+# Response headers aiohttp recomputes for the body it sends, never copied back
+_SKIPPED_RESPONSE_HEADERS = frozenset({'transfer-encoding', 'content-length', 'content-encoding'})
+
+# Optional MessagePack wire format, negotiated per tunnel (see tunnel_control)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# packb() builds a fresh Packer per call. Encoding only happens on the
+# event loop thread and pack() never yields, so one Packer can be reused.
+_packer = msgpack.Packer(use_bin_type=True) if msgpack is not None else None
+
+def encode_message(o, wire: str = 'json') -> bytes:
+    """Serialize a tunnel message in the tunnel's wire format"""
+    if wire == 'msgpack':
+        return _packer.pack(o)
+    return dumps(o)
+
+def decode_message(data, wire: str = 'json'):
+    """Deserialize a tunnel message; text frames are always JSON"""
+    if wire == 'msgpack' and isinstance(data, (bytes, bytearray)):
+        return msgpack.unpackb(data, raw=False)
+    return loads(data)
+
+class Tunnel:
+    """Everything known about one connected tunnel, found with a single lookup"""
+    __slots__ = ('ws', 'project_id', 'wire', 'sender', 'slots')
+
+    def __init__(self, ws: web.WebSocketResponse, project_id: int, wire: str = 'json'):
+        self.ws = ws
+        self.project_id = project_id
+        self.wire = wire  # 'json' or 'msgpack'
+        # Single writer for everything sent down this tunnel
+        self.sender = TunnelSender(ws, wire)
+        # Caps concurrent proxied requests so one busy tunnel can't queue
+        # unbounded sends and pending responses
+        self.slots = asyncio.Semaphore(MAX_TUNNEL_IN_FLIGHT)
+
+    def close(self):
+        self.sender.close()
+
+# Coalesced msgpack frames are cut at about this size, far below the agent's
+# 10MB max_msg_size (a single larger message still goes in a frame of its own)
+MAX_COALESCED_BYTES = 1024 * 1024
+
+class TunnelSender:
+    """
+    Send queue for one tunnel, drained by a single writer task.
+
+    On msgpack tunnels, messages queued in the same event loop tick go out
+    as one WebSocket frame holding a msgpack array, instead of one frame
+    (and TLS record) each; a lone message is still sent as a plain map.
+    JSON agents expect one message per frame, so there each queued message
+    gets its own frame, still written in order by the one task. Frames
+    queued already encoded (send_encoded) always go out on their own.
+    """
+
+    def __init__(self, ws: web.WebSocketResponse, wire: str = 'msgpack'):
+        self._ws = ws
+        self._wire = wire
+        self._queue = asyncio.Queue()
+        self._closed = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def send(self, message: dict) -> asyncio.Future:
+        """Queue a message; the returned future resolves once it is on the wire"""
+        return self._enqueue(message)
+
+    def post(self, message: dict) -> None:
+        """Queue a message nobody waits on; a failed send is dropped"""
+        self.send(message).add_done_callback(_discard_result)
+
+    def send_encoded(self, data: bytes) -> asyncio.Future:
+        """Queue an already-encoded frame, sent alone and in queue order"""
+        return self._enqueue(data)
+
+    def _enqueue(self, item) -> asyncio.Future:
+        sent = asyncio.get_running_loop().create_future()
+        if self._closed:
+            sent.set_exception(ConnectionResetError("Tunnel closed"))
+        else:
+            self._queue.put_nowait((item, sent))
+        return sent
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                run = []
+                for item in batch:
+                    if isinstance(item[0], bytes):
+                        await self._write_messages(run)
+                        run = []
+                        await self._write(item[0], (item,))
+                    else:
+                        run.append(item)
+                await self._write_messages(run)
+            except asyncio.CancelledError:
+                # Closed mid-write; whatever wasn't sent fails with the rest
+                self._settle(batch, ConnectionResetError("Tunnel closed"))
+                raise
+
+    async def _write_messages(self, batch):
+        if not batch:
+            return
+        if self._wire == 'msgpack':
+            await self._write_coalesced(batch)
+        else:
+            for message, sent in batch:
+                try:
+                    data = encode_message(message, self._wire)
+                except Exception as e:
+                    self._settle(((None, sent),), e)
+                    continue
+                await self._write(data, ((data, sent),))
+
+    async def _write_coalesced(self, batch):
+        """
+        Pack the batch into as few frames as possible, starting a new frame
+        once MAX_COALESCED_BYTES is reached so a busy tick can't produce a
+        frame over the agent's max_msg_size
+        """
+        frame, size = [], 0
+        for message, sent in batch:
+            try:
+                packed = _packer.pack(message)
+            except Exception as e:
+                _packer.reset()
+                self._settle(((None, sent),), e)
+                continue
+            if frame and size + len(packed) > MAX_COALESCED_BYTES:
+                await self._write_frame(frame)
+                frame, size = [], 0
+            frame.append((packed, sent))
+            size += len(packed)
+        if frame:
+            await self._write_frame(frame)
+
+    async def _write_frame(self, frame):
+        # A msgpack array is its header followed by the packed items, so
+        # already-packed messages are joined instead of packed again
+        if len(frame) == 1:
+            data = frame[0][0]
+        else:
+            data = _packer.pack_array_header(len(frame)) + b"".join(packed for packed, _ in frame)
+        await self._write(data, frame)
+
+    async def _write(self, data: bytes, frame):
+        """Send one frame and settle the futures of the messages it carries"""
+        try:
+            await self._ws.send_bytes(data)
+        except Exception as e:
+            self._settle(frame, e)
+            return
+        self._settle(frame)
+
+    @staticmethod
+    def _settle(frame, error: Optional[Exception] = None):
+        for _, sent in frame:
+            if sent.done():
+                continue
+            if error is not None:
+                sent.set_exception(error)
+            else:
+                sent.set_result(None)
+
+    def close(self):
+        """Stop the writer and fail every queued send right away"""
+        self._closed = True
+        self._task.cancel()
+        error = ConnectionResetError("Tunnel closed")
+        while not self._queue.empty():
+            self._settle((self._queue.get_nowait(),), error)
+
+def _discard_result(sent: asyncio.Future):
+    # Retrieve the outcome so a failed fire-and-forget send isn't reported
+    # as "exception was never retrieved"
+    if not sent.cancelled():
+        sent.exception()
 
 def normalize_incoming_headers(hdrs: aiohttp.typedefs.LooseHeaders) -> Dict[str, str]:
     """
@@ -112,25 +457,22 @@ def normalize_incoming_headers(hdrs: aiohttp.typedefs.LooseHeaders) -> Dict[str,
         hdrs: aiohttp headers
         
     Returns:
-        Dict of header name to value
+        Dict of lowercased header name to value (hop-by-hop headers and
+        Host removed; for repeated headers the last value wins)
     """
-    result = {}
-    
-    for k, v in hdrs.items():
-        k = k.lower()
-        
-        # Skip hop-by-hop headers
-        if k in ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
-                 'te', 'trailers', 'transfer-encoding', 'upgrade'):
-            continue
-            
-        # Skip host header (will be set by the client)
-        if k == 'host':
-            continue
-            
-        result[k] = v
-        
-    return result
+    normalized = {}
+    for name, value in hdrs.items():
+        key = _normalize_header_name(name)
+        if key is not None:
+            normalized[key] = value
+    return normalized
+
+@lru_cache(maxsize=1024)
+def _normalize_header_name(name: str) -> Optional[str]:
+    # Only names are cached: values (cookies, auth tokens) stay out of
+    # process-lifetime memory, and the set of distinct names is small
+    key = name.lower()
+    return None if key in _SKIPPED_REQUEST_HEADERS else key
 
 def get_project_by_subdomain(subdomain: str):
     """
@@ -156,7 +498,8 @@ def get_tunnel_by_subdomain(subdomain: str):
     Returns:
         WebSocket connection or None
     """
-    return tunnels.get(subdomain)
+    tunnel = tunnels.get(subdomain)
+    return tunnel.ws if tunnel else None
 
 def get_tunnel_stats():
     """
@@ -188,6 +531,9 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
     project_id = query.get('project_id')
     api_key = query.get('api_key')
     
+    # Agents that can speak MessagePack ask for it; older ones get JSON
+    wire = 'msgpack' if query.get('wire') == 'msgpack' and msgpack is not None else 'json'
+    
     # Validate parameters
     if not project_id or not api_key:
         return web.Response(text="Missing required parameters", status=400)
@@ -215,8 +561,9 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
 
 # Find this section (around line 240-250):
     try:
-        project = db.query(project_model).filter_by(id=project_id).first()
-        log.debug(f"🔍 Project lookup result: {project}")
+        # Primary-key lookup: identity map first, no query compilation
+        project = db.get(project_model, project_id)
+        log.debug("🔍 Project lookup result: %s", project)
         
         if not project:
             return web.Response(text=f"Project not found: {project_id}", status=404)
@@ -238,8 +585,6 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
             username = "unknown"
             
         # Get or generate subdomain
-        from subdomain_handling import generate_subdomain, extract_subdomain
-        
         if not project.subdomain:
             project.subdomain = generate_subdomain(
                 project_name=project_name,
@@ -252,29 +597,10 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
         subdomain = project.subdomain
         log.debug(f"🔍 Project details - name: {project_name}, subdomain: {subdomain}, user: {username}")
         
-        # Update project status
-        try:
-            # Try with timestamp (float)
-            project.last_started = time.time()
-            project.status = "running"
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            log.debug(f"Timestamp update failed: {e}, trying datetime")
-            
-            # Try with datetime if timestamp fails
-            try:
-                project.last_started = datetime.datetime.utcnow()
-                project.status = "running"
-                db.commit()
-            except Exception as e2:
-                db.rollback()
-                log.error(f"Both timestamp and datetime updates failed: {e2}")
-                # Continue without updating last_started
-                project.status = "running"
-                db.commit()
+        # Update project status (written behind, see flush_project_status)
+        queue_project_status(project_model, project_id, "running", datetime.datetime.utcnow())
         
-        log.debug(f"🔍 Updated project status to 'running'")
+        log.debug(f"🔍 Queued project status 'running'")
         
     except Exception as e:
         db.rollback()
@@ -283,46 +609,77 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
     finally:
         db.close()
     # Set up WebSocket
-    ws = web.WebSocketResponse()
+    # No per-message deflate on the msgpack wire: bodies are sent raw and
+    # mostly already compressed, so zlib would only burn CPU
+    ws = web.WebSocketResponse(compress=wire != 'msgpack')
     await ws.prepare(request)
     
     # Register the tunnel
-    tunnels[subdomain] = ws
-    tunnel_to_project[subdomain] = project_id
+    tunnel = Tunnel(ws, project_id, wire)
+    tunnels[subdomain] = tunnel
+    _inactive_lookups.pop(subdomain, None)
     
     # Log the new tunnel
     log.info(f"✓ New tunnel: https://{subdomain}.{domain} (Project: {project_name}, ID: {project_id}, User: {username})")
 
     
-    # Send connection confirmation
-    await ws.send_bytes(dumps({
-        "type": "connected",
-        "subdomain": subdomain,
-        "url": f"https://{subdomain}.{domain}"
-    }))
-    log.debug(f"🔍 Sent connection confirmation message")
-    
     try:
+        # Send connection confirmation (always JSON; "wire" tells the agent
+        # which format every later frame uses). It goes through the sender,
+        # queued before anything http_handler can send, so it is first
+        await tunnel.sender.send_encoded(dumps({
+            "type": "connected",
+            "subdomain": subdomain,
+            "url": f"https://{subdomain}.{domain}",
+            "wire": wire,
+            "stream_window": STREAM_QUEUE_SIZE
+        }))
+        log.debug(f"🔍 Sent connection confirmation message")
+
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.BINARY or msg.type == aiohttp.WSMsgType.TEXT:
                 try:
                     # Handle both binary and text messages
-                    if msg.type == aiohttp.WSMsgType.BINARY:
-                        data = loads(msg.data)
-                    else:  # TEXT
-                        data = json.loads(msg.data)
+                    data = decode_message(msg.data, wire)
                         
                     msg_type = data.get("type")
-                    log.debug(f"Received WebSocket {msg.type} message: {msg_type}")
+                    log.debug("Received WebSocket %s message: %s", msg.type, msg_type)
                     
-                    if msg_type == "http_response":
-                        # Handle HTTP response from tunnel
+                    if msg_type in ("http_response", "http_response_start"):
+                        # Handle HTTP response from tunnel (whole, or the
+                        # head of a streamed one)
                         request_id = data.get("request_id")
-                        if request_id in pending_requests:
-                            pending_requests[request_id]['response'] = data
-                            pending_requests[request_id]['event'].set()
+                        future, target = pending_requests.get(request_id, (None, None))
+                        # Only the tunnel a request was sent to may answer it
+                        if future is not None and target is tunnel:
+                            # The waiter holds the future; drop the entry now
+                            # rather than when http_handler resumes
+                            pending_requests.pop(request_id, None)
+                            if not future.done():
+                                if msg_type == "http_response_start":
+                                    data["chunks"] = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE + 1)
+                                    response_streams[request_id] = (data["chunks"], tunnel)
+                                future.set_result(data)
                         else:
                             log.warning(f"Received response for unknown request ID: {request_id}")
+                    elif msg_type in ("http_response_chunk", "http_response_end"):
+                        request_id = data.get("request_id")
+                        chunks, target = response_streams.get(request_id, (None, None))
+                        if chunks is not None and target is tunnel:
+                            if msg_type == "http_response_end":
+                                response_streams.pop(request_id, None)
+                                if data.get("error"):
+                                    # The agent lost the local response midway
+                                    abort_stream(chunks)
+                                else:
+                                    chunks.put_nowait(None)
+                            elif chunks.qsize() < STREAM_QUEUE_SIZE:
+                                chunks.put_nowait(data.get("body", b""))
+                            else:
+                                log.warning(f"Tunnel overran the window of streamed response {request_id}; dropping it")
+                                response_streams.pop(request_id, None)
+                                abort_stream(chunks)
+                                tunnel.sender.post({"type": "http_response_cancel", "request_id": request_id})
                     else:
                         log.warning(f"Unknown message type: {msg_type}")
                 except Exception as e:
@@ -332,14 +689,60 @@ async def tunnel_control(request: web.Request, verify_api_key_func, db_session:
                 break
     finally:
         # Clean up when the connection is closed
-        if subdomain in tunnels:
+        # (unless a newer connection has already taken over the subdomain)
+        if tunnels.get(subdomain) is tunnel:
             del tunnels[subdomain]
-        if subdomain in tunnel_to_project:
-            del tunnel_to_project[subdomain]
+        tunnel.close()
+        # Requests still waiting on this tunnel get a 502 now rather than
+        # after REQUEST_TIMEOUT (a newer tunnel's requests are left alone)
+        for request_id, (future, target) in list(pending_requests.items()):
+            if target is tunnel and not future.done():
+                future.set_exception(ConnectionResetError("Tunnel closed"))
+        # Fail any response this tunnel was still streaming
+        for request_id, (chunks, target) in list(response_streams.items()):
+            if target is tunnel:
+                response_streams.pop(request_id, None)
+                abort_stream(chunks)
         log.info(f"❌ Tunnel closed: {subdomain}.{domain}")
         
     return ws
 
+@lru_cache(maxsize=None)
+def _project_name_by_subdomain(project_model):
+    """Build the inactive-tunnel lookup once per model; the subdomain is a bind parameter"""
+    return (select(project_model.name)
+            .where(project_model.subdomain == bindparam('sd'))
+            .limit(1))
+
+def lookup_inactive_project(db_session: scoped_session, project_model, subdomain: str) -> Optional[str]:
+    """
+    Name of the project owning a subdomain that has no active tunnel
+    
+    Hits and misses are both cached for INACTIVE_LOOKUP_TTL, so repeated
+    requests (or a bot walking random subdomains) don't each query the DB.
+    
+    Returns:
+        Project name, or None if no project uses the subdomain
+    """
+    now = time.monotonic()
+    cached = _inactive_lookups.get(subdomain)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    # Use the pooled session factory passed in (not Flask's app-bound
+    # session) and only fetch the name
+    db = db_session()
+    try:
+        project_name = db.execute(_project_name_by_subdomain(project_model), {'sd': subdomain}).scalar()
+    finally:
+        db.close()
+
+    _inactive_lookups[subdomain] = (now + INACTIVE_LOOKUP_TTL, project_name)
+    _inactive_lookups.move_to_end(subdomain)
+    if len(_inactive_lookups) > INACTIVE_LOOKUP_MAX:
+        _inactive_lookups.popitem(last=False)
+    return project_name
+
 async def http_handler(request: web.Request, domain: str, db_session: scoped_session, 
                       project_model, status_handler_func, firewall_rule_model=None):
     """
@@ -351,7 +754,6 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
         loop = asyncio.get_running_loop()
         loop.create_task(cleanup_task())
         globals()['_cleanup_task_started'] = True
-    from subdomain_handling import extract_subdomain
     
     # Get client IP (Cloudflare-aware)
     client_ip = request.headers.get('CF-Connecting-IP') or \
@@ -375,32 +777,16 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
     if subdomain is None:
         return await status_handler_func(request)
 
-    ws = tunnels.get(subdomain)
-    if not ws:
-        # Create a direct database session instead of using Flask's scoped session
-        from sqlalchemy import create_engine
-        from sqlalchemy.orm import sessionmaker
-        
-        # Get the database path from your app configuration
-        INSTANCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
-        DATABASE_PATH = os.path.join(INSTANCE_FOLDER, 'app.db')
-        DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
-        
-        engine = create_engine(DATABASE_URL)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        
-        db = SessionLocal()
-        try:
-            project = db.query(project_model).filter_by(subdomain=subdomain).first()
-            if project:
-                return web.Response(
-                    text=f"Project '{project.name}' exists but tunnel is not active.\n"
-                         f"Please start the project to activate the tunnel.\n"
-                         f"Subdomain: {subdomain}.{domain}",
-                    status=503
-                )
-        finally:
-            db.close()
+    tunnel = tunnels.get(subdomain)
+    if not tunnel:
+        project_name = lookup_inactive_project(db_session, project_model, subdomain)
+        if project_name is not None:
+            return web.Response(
+                text=f"Project '{project_name}' exists but tunnel is not active.\n"
+                     f"Please start the project to activate the tunnel.\n"
+                     f"Subdomain: {subdomain}.{domain}",
+                status=503
+            )
         
         return web.Response(
             text=f"Tunnel not found: {subdomain}.{domain}",
@@ -408,7 +794,7 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
         )
 
     # Get the project ID for this subdomain
-    project_id = tunnel_to_project.get(subdomain)
+    project_id = tunnel.project_id
     if not project_id:
         return web.Response(
             text=f"Project ID not found for subdomain: {subdomain}",
@@ -416,16 +802,13 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
         )
     
     # Check firewall rules if firewall_rule_model is provided
-# Check firewall rules if firewall_rule_model is provided
     if firewall_rule_model:
         try:
             method = request.method
             path = request.path
             
             # Use our modified firewall implementation that doesn't rely on Flask context
-            try:
-                import firewall_aiohttp
-                
+            if firewall_aiohttp is not None:
                 # Pass client_ip to the firewall check
                 is_blocked, reason = firewall_aiohttp.is_request_blocked(
                     project_id, firewall_rule_model, method, path, client_ip
@@ -442,24 +825,31 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
                             "X-Firewall-Request-Logged": "true"
                         }
                     )
-            except ImportError as e:
-                log.error(f"Error importing firewall module: {e}")
         except Exception as e:
             # Log the error but continue processing the request
             log.error(f"Error checking firewall rules: {e}", exc_info=True)
 
-    request_id = secrets.token_hex(8)
-    event = asyncio.Event()
-    pending_requests[request_id] = {
-        'event': event,
-        'response': None,
-        'timestamp': time.time()
-    }
+    if len(pending_requests) >= MAX_PENDING_REQUESTS:
+        log.warning(f"Too many pending tunnel requests ({len(pending_requests)}); rejecting")
+        return web.Response(text="Tunnel busy", status=503, headers={"Retry-After": "1"})
+
+    try:
+        await asyncio.wait_for(tunnel.slots.acquire(), timeout=TUNNEL_SLOT_WAIT)
+    except asyncio.TimeoutError:
+        log.warning(f"Tunnel {subdomain} has {MAX_TUNNEL_IN_FLIGHT} requests in flight; rejecting")
+        return web.Response(text="Tunnel busy", status=503, headers={"Retry-After": "1"})
+
+    request_id = next(_request_ids)
+    future = asyncio.get_running_loop().create_future()
+    pending_requests[request_id] = (future, tunnel)
+    # Send timeout plus response timeout, with a little slack
+    heapq.heappush(_pending_deadlines, (time.monotonic() + REQUEST_TIMEOUT + 10.0, request_id))
 
     query_string = request.query_string
 
     try:
         body = await request.read()
+        wire = tunnel.wire
 
         payload = {
             "type": "http_request",
@@ -468,36 +858,38 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
             "path": request.path,
             "query_string": query_string,
             "headers": normalize_incoming_headers(request.headers),
-            "body": body.decode("utf-8", errors="ignore")
+            # MessagePack carries raw bytes as-is
+            "body": body
         }
+        if wire != 'msgpack':
+            # JSON needs text: UTF-8 bodies go as-is, anything else (file
+            # uploads, protobuf, ...) as base64 rather than mangled
+            try:
+                payload["body"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                payload["body"] = base64.b64encode(body).decode("ascii")
+                payload["is_binary"] = True
 
         # Add timeout to prevent hanging
         try:
-            await asyncio.wait_for(
-                ws.send_bytes(dumps(payload)),
-                timeout=5.0
-            )
+            await asyncio.wait_for(tunnel.sender.send(payload), timeout=5.0)
         except asyncio.TimeoutError:
             log.error(f"Timeout sending request to tunnel: {subdomain}")
             return web.Response(text="Tunnel send timeout", status=504)
         
-        if log.isEnabledFor(logging.DEBUG):
-            log.debug(f"→ {request.method} {subdomain}.{domain}{request.path}")
+        log.debug("→ %s %s.%s%s", request.method, subdomain, domain, request.path)
 
         # Wait for response
         try:
-            await asyncio.wait_for(event.wait(), timeout=REQUEST_TIMEOUT)
+            response_data = await asyncio.wait_for(future, timeout=REQUEST_TIMEOUT)
         except asyncio.TimeoutError:
             log.warning(f"Timeout waiting for response from tunnel: {subdomain}")
             return web.Response(text="Tunnel timeout", status=504)
-
-        response_data = pending_requests[request_id]['response']
         
         if not response_data:
             return web.Response(text="No response from tunnel", status=502)
 
         status = int(response_data.get("status", 200))
-        resp = web.Response(status=status)
 
         headers_data = response_data.get("headers", {})
         
@@ -506,38 +898,151 @@ async def http_handler(request: web.Request, domain: str, db_session: scoped_ses
         else:
             headers_items = headers_data
             
+        forward_headers = CIMultiDict()
         for key, value in headers_items:
             k = str(key).strip()
             if not k:
                 continue
-            lk = k.lower()
-            if lk in ("transfer-encoding", "content-length", "content-encoding"):
+            if k.lower() in _SKIPPED_RESPONSE_HEADERS:
                 continue
-            resp.headers.add(k, str(value))
+            forward_headers.add(k, str(value))
 
         # Handle both text and binary responses
         body_data = response_data.get("body", "")
         is_binary = response_data.get("is_binary", False)
         
+        if response_data.get("type") == "http_response_start":
+            # Body follows in http_response_chunk messages; each chunk the
+            # client takes gives the agent credit for one more
+            ack = {"type": "http_response_ack", "request_id": request_id}
+            return await relay_response_stream(request, status, forward_headers, response_data["chunks"],
+                                               lambda: tunnel.sender.post(ack))
+
+        if is_binary and isinstance(body_data, str) and len(body_data) > STREAM_BODY_THRESHOLD:
+            # Large binary bodies are decoded and sent a slice at a time, so
+            # the full decoded body is never held alongside its base64 text
+            return await stream_base64_body(request, status, forward_headers, body_data)
+
         if is_binary:
             # Decode base64 binary data (images, PDFs, etc.)
             try:
-                resp.body = base64.b64decode(body_data)
+                body = base64.b64decode(body_data)
             except Exception as e:
                 log.error(f"Error decoding binary response: {e}")
-                resp.body = b""
-        elif isinstance(body_data, bytes):
-            resp.body = body_data
+                body = b""
+        elif isinstance(body_data, (bytes, bytearray)):
+            # msgpack tunnels deliver the body as-is
+            body = body_data
+        elif isinstance(body_data, str):
+            body = body_data.encode("utf-8")
         else:
-            resp.body = str(body_data).encode("utf-8")
+            body = str(body_data).encode("utf-8")
 
-        return resp
+        # Body and prebuilt headers go straight into the constructor
+        return web.Response(status=status, body=body, headers=forward_headers)
 
     except Exception as e:
         log.error(f"Error routing request: {e}", exc_info=True)
         return web.Response(text=f"Tunnel error: {e}", status=502)
     finally:
+        tunnel.slots.release()
         pending_requests.pop(request_id, None)
+        stream = response_streams.pop(request_id, None)
+        if stream is not None:
+            # Relay gave up early; drop the chunks it never took and stop
+            # the agent sending more
+            chunks, _ = stream
+            while not chunks.empty():
+                chunks.get_nowait()
+            tunnel.sender.post({"type": "http_response_cancel", "request_id": request_id})
+
+def abort_stream(chunks: asyncio.Queue):
+    """Fail a streamed response now, discarding chunks the client hasn't taken"""
+    while not chunks.empty():
+        chunks.get_nowait()
+    chunks.put_nowait(STREAM_ABORTED)
+
+def abort_response(request: web.Request, resp: web.StreamResponse):
+    """
+    Drop the client connection of a response whose body was cut short
+
+    Ending it with write_eof would send a normal chunked terminator, and a
+    truncated body would look complete; a closed connection reads as a
+    failed response instead.
+    """
+    resp.force_close()
+    if request.transport is not None:
+        request.transport.close()
+
+async def relay_response_stream(request: web.Request, status: int, headers: CIMultiDict,
+                                chunks: asyncio.Queue,
+                                on_chunk: Optional[Callable[[], None]] = None) -> web.StreamResponse:
+    """
+    Relay a streamed tunnel response, writing each chunk as it arrives
+    
+    Args:
+        request: incoming request being answered
+        status: HTTP status code
+        headers: response headers
+        chunks: queue of body chunks (bytes), ended by None, or by
+            STREAM_ABORTED if the body can't be completed
+        on_chunk: called after each chunk is written to the client
+        
+    Returns:
+        The prepared StreamResponse, finished or aborted
+    """
+    resp = web.StreamResponse(status=status, headers=headers)
+    await resp.prepare(request)
+    try:
+        while True:
+            chunk = await asyncio.wait_for(chunks.get(), timeout=REQUEST_TIMEOUT)
+            if chunk is None:
+                break
+            if chunk is STREAM_ABORTED:
+                log.warning("Streamed response from tunnel aborted")
+                abort_response(request, resp)
+                return resp
+            # A client that stops reading would otherwise hold the write forever
+            await asyncio.wait_for(resp.write(chunk), timeout=REQUEST_TIMEOUT)
+            if on_chunk is not None:
+                on_chunk()
+    except asyncio.TimeoutError:
+        log.warning("Timeout relaying streamed response between tunnel and client")
+        abort_response(request, resp)
+        return resp
+    except Exception as e:
+        # Headers are already sent; fail the connection, not the body
+        log.error(f"Error relaying streamed response: {e}")
+        abort_response(request, resp)
+        return resp
+    await resp.write_eof()
+    return resp
+
+async def stream_base64_body(request: web.Request, status: int, headers: CIMultiDict, body_b64: str) -> web.StreamResponse:
+    """
+    Send a base64-encoded tunnel response body, decoding it in slices
+    
+    Args:
+        request: incoming request being answered
+        status: HTTP status code
+        headers: response headers
+        body_b64: base64 text without whitespace (as sent by the agent)
+        
+    Returns:
+        The prepared and finished StreamResponse
+    """
+    resp = web.StreamResponse(status=status, headers=headers)
+    await resp.prepare(request)
+    try:
+        for start in range(0, len(body_b64), STREAM_CHUNK_CHARS):
+            await resp.write(base64.b64decode(body_b64[start:start + STREAM_CHUNK_CHARS]))
+    except Exception as e:
+        # Headers are already sent; fail the connection, not the body
+        log.error(f"Error streaming binary response: {e}")
+        abort_response(request, resp)
+        return resp
+    await resp.write_eof()
+    return resp
 
 def start_cleanup_task():
     """Start the background task to clean up expired requests"""
@@ -1,5 +1,5 @@
 import os, secrets
-from PIL import Image
+from PIL import Image, ImageOps
 from werkzeug.utils import secure_filename
 from flask import current_app
 
@@ -17,9 +17,55 @@ def user_upload_dir(user_id: int) -> str:
     os.makedirs(path, exist_ok=True)
     return path
 
+def remove_image_files(user_dir: str, stored_filename: str) -> bool:
+    """
+    Removes a stored image and its thumbnail from user_dir.
+    Needs no app context, so it can run on worker threads.
+    Returns True if the original was removed.
+    """
+    thumb_name = stored_filename.rsplit('.', 1)[0] + "_thumb.jpg"
+    removed = False
+    for name in (stored_filename, thumb_name):
+        try:
+            os.remove(os.path.join(user_dir, name))
+            removed = removed or name == stored_filename
+        except OSError:
+            pass
+    return removed
+
+def delete_user_image(stored_filename: str, user_id: int) -> bool:
+    """Removes a user's stored image and thumbnail from the upload folder."""
+    base = current_app.config['UPLOAD_FOLDER']
+    return remove_image_files(os.path.join(base, str(user_id)), stored_filename)
+
 def random_name(ext: str) -> str:
     return secrets.token_hex(16) + '.' + ext
 
+def _stream_to_file(stream, path: str, max_bytes: int, chunk_size: int = 64 * 1024):
+    """
+    Copies stream to path in one pass, counting bytes as it goes.
+    Returns the size, or None (and no file) once max_bytes is exceeded.
+    """
+    size = 0
+    try:
+        with open(path, 'xb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    break
+                out.write(chunk)
+        if size > max_bytes:
+            os.remove(path)
+            return None
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return size
+
 def save_user_image(file_storage, user_id: int):
     """
     Saves original image, creates thumbnail.
@@ -33,25 +79,20 @@ def save_user_image(file_storage, user_id: int):
     if not allowed_image(orig_name):
         raise ValueError("Unsupported image type.")
 
-    # Read fully to check size
-    file_storage.stream.seek(0, 2)
-    size_bytes = file_storage.stream.tell()
-    file_storage.stream.seek(0)
-
     # Limit (optional custom)
     max_bytes = current_app.config.get('GALLERY_MAX_FILE_BYTES', 5 * 1024 * 1024)
-    if size_bytes > max_bytes:
-        raise ValueError("File too large.")
 
     storage_name = random_name(ext)
     user_dir = user_upload_dir(user_id)
     full_path = os.path.join(user_dir, storage_name)
-    file_storage.save(full_path)
+    size_bytes = _stream_to_file(file_storage.stream, full_path, max_bytes)
+    if size_bytes is None:
+        raise ValueError("File too large.")
 
-    # Verify it is an image
+    # Verify it is an image: one open, fully decoded (no separate verify pass)
     try:
-        with Image.open(full_path) as img:
-            img.verify()  # quick integrity check
+        img = Image.open(full_path)
+        img.load()
     except Exception:
         try:
             os.remove(full_path)
@@ -59,19 +100,19 @@ def save_user_image(file_storage, user_id: int):
             pass
         raise ValueError("Corrupted or invalid image.")
 
-    # Re-open for dimension + orientation fix
-    with Image.open(full_path) as img:
-        img = _auto_orient(img)
+    with img:
+        # Apply the EXIF orientation (all 8 cases) with a transpose, not a rotate
+        img = ImageOps.exif_transpose(img)
         width, height = img.size
         # (Optional) store normalized version (overwriting original if orientation changed)
         img.save(full_path)
 
-        # Thumbnail
+        # Thumbnail; reducing_gap shrinks by whole factors first, which is much
+        # cheaper than resampling the full image for large downscales
         thumb_name = storage_name.rsplit('.', 1)[0] + "_thumb.jpg"
         thumb_path = os.path.join(user_dir, thumb_name)
-        thumb = img.copy()
-        thumb.thumbnail((400, 400))
-        thumb.save(thumb_path, 'JPEG', quality=82, optimize=True)
+        img.thumbnail((400, 400), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        img.save(thumb_path, 'JPEG', quality=82, optimize=True, progressive=True)
 
     return {
         "original_filename": orig_name,
@@ -82,14 +123,3 @@ def save_user_image(file_storage, user_id: int):
         "width": width,
         "height": height
     }
-
-def _auto_orient(img: Image.Image) -> Image.Image:
-    try:
-        exif = img.getexif()
-        orientation = exif.get(0x0112)
-        rotate_map = {3: 180, 6: 270, 8: 90}
-        if orientation in rotate_map:
-            img = img.rotate(rotate_map[orientation], expand=True)
-    except Exception:
-        pass
-    return img
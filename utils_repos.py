@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from werkzeug.utils import secure_filename
 from flask import current_app
 
@@ -7,6 +8,11 @@ def repo_disk_path(username: str, repo_name: str) -> str:
     base_path = current_app.config.get('REPOS_FOLDER', 'repos')
     return os.path.join(base_path, username, repo_name)
 
+@lru_cache(maxsize=512)
+def _real_base(base_path: str) -> str:
+    """realpath() of a repo base; repeated lookups under one repo resolve it once"""
+    return os.path.realpath(base_path)
+
 def safe_subpath(base_path: str, subpath: str) -> str:
     """Safely join base path with subpath, preventing directory traversal"""
     if not subpath:
@@ -30,60 +36,50 @@ def safe_subpath(base_path: str, subpath: str) -> str:
     
     # Ensure the result is still within the base path
     try:
-        base_real = os.path.realpath(base_path)
+        base_real = _real_base(base_path)
         result_real = os.path.realpath(result_path)
-        if not result_real.startswith(base_real):
+        # Compare whole components: '/repos/ab' must not pass for '/repos/a'
+        if os.path.commonpath([base_real, result_real]) != base_real:
             return None
     except (OSError, ValueError):
         return None
     
     return result_path
 
+# File type by extension, built once rather than per call
+_CODE_EXTENSIONS = frozenset({
+    'py', 'js', 'ts', 'tsx', 'jsx', 'html', 'css', 'scss', 'less',
+    'json', 'xml', 'yaml', 'yml', 'md', 'txt', 'sql', 'sh', 'bat',
+    'php', 'rb', 'go', 'rs', 'cpp', 'c', 'h', 'java', 'kt', 'swift'
+})
+_IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'bmp', 'ico'})
+_DOC_EXTENSIONS = frozenset({'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'})
+_ARCHIVE_EXTENSIONS = frozenset({'zip', 'tar', 'gz', 'rar', '7z', 'bz2'})
+
+_FILE_TYPES = {
+    **{ext: 'code' for ext in _CODE_EXTENSIONS},
+    **{ext: 'image' for ext in _IMAGE_EXTENSIONS},
+    **{ext: 'document' for ext in _DOC_EXTENSIONS},
+    **{ext: 'archive' for ext in _ARCHIVE_EXTENSIONS},
+}
+
 def get_file_type(filename: str) -> str:
     """Get file type based on extension"""
     if '.' not in filename:
         return 'unknown'
     
     ext = filename.rsplit('.', 1)[1].lower()
-    
-    # Code files
-    code_extensions = {
-        'py', 'js', 'ts', 'tsx', 'jsx', 'html', 'css', 'scss', 'less',
-        'json', 'xml', 'yaml', 'yml', 'md', 'txt', 'sql', 'sh', 'bat',
-        'php', 'rb', 'go', 'rs', 'cpp', 'c', 'h', 'java', 'kt', 'swift'
-    }
-    
-    # Image files
-    image_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'svg', 'bmp', 'ico'}
-    
-    # Document files
-    doc_extensions = {'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx'}
-    
-    # Archive files
-    archive_extensions = {'zip', 'tar', 'gz', 'rar', '7z', 'bz2'}
-    
-    if ext in code_extensions:
-        return 'code'
-    elif ext in image_extensions:
-        return 'image'
-    elif ext in doc_extensions:
-        return 'document'
-    elif ext in archive_extensions:
-        return 'archive'
-    else:
-        return 'unknown'
+    return _FILE_TYPES.get(ext, 'unknown')
+
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
 
 def format_file_size(size_bytes: int) -> str:
     """Format file size in human readable format"""
     if size_bytes == 0:
         return "0 B"
     
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    size = float(size_bytes)
-    
-    while size >= 1024.0 and i < len(size_names) - 1:
-        size /= 1024.0
-        i += 1
+    # Each unit is 2**10 of the previous one, so the bit length picks it directly
+    i = (int(size_bytes).bit_length() - 1) // 10 if size_bytes >= 1 else 0
+    i = min(i, len(_SIZE_NAMES) - 1)
     
-    return f"{size:.1f} {size_names[i]}"
+    return f"{size_bytes / (1 << (i * 10)):.1f} {_SIZE_NAMES[i]}"